@@ -9,12 +9,18 @@ Search in and download from Polona.pl
 Usage: 'ppolona' for GUI, 'ppolona -h' for CLI
 """
 
+import argparse
+import multiprocessing
 import pathlib
 
 try:
     from .polona import *
 except ImportError:
     from pypolona.polona import *
+try:
+    from .service import serve
+except ImportError:
+    from pypolona.service import serve
 try:
     from . import *
 except ImportError:
@@ -25,6 +31,7 @@ except ImportError:
     from pypolona.__init__ import __version__ as version
 
 from ezgooey.ez import *
+import ezgooey.logging as logging
 
 # from cli2gui import Cli2Gui
 
@@ -54,7 +61,7 @@ DESCRIPTION = (
     program_description=None,
     program_name=GUI_NAME,
     progress_expr=None,
-    progress_regex=None,
+    progress_regex=r"^progress: (\d+)%$",
     required_cols=1,
     richtext_controls=True,
     show_failure_modal=True,
@@ -95,10 +102,24 @@ def gui():
 #     return cli()
 
 
+def page_ranges(spec):
+    try:
+        parse_page_ranges(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return spec
+
+
+def resolution(value):
+    if value in ("max", "min") or value.isdigit():
+        return value
+    raise argparse.ArgumentTypeError("Use max, min or a width in pixels: %r" % value)
+
+
 def cli():
     parser = ArgumentParser(prog="ppolona", description=DESCRIPTION)
 
-    query_help = "query is a Polona.pl URL unless you choose search, advanced or ids"
+    query_help = "query is a Polona.pl URL unless you choose another query type"
 
     parser_q = parser.add_argument_group(
         "Input", gooey_options={"show_border": True, "columns": 2, "margin_top": 0}
@@ -154,6 +175,51 @@ def cli():
             "show_help": True,
         },
     )
+    command.add_argument(
+        "--verify",
+        dest="verify",
+        action="store_true",
+        help="Query is download folders, check their docs and output the IDs to download again",
+        gooey_options={
+            "show_help": True,
+        },
+    )
+    command.add_argument(
+        "--serve",
+        dest="serve",
+        action="store_true",
+        help="Query is host:port or unix:/socket/path, run a local job API there",
+        gooey_options={
+            "show_help": True,
+        },
+    )
+    command.add_argument(
+        "--retag",
+        dest="retag",
+        action="store_true",
+        help="Query is download folders, rewrite the metadata of their PDFs offline",
+        gooey_options={
+            "show_help": True,
+        },
+    )
+    command.add_argument(
+        "--pack",
+        dest="pack",
+        action="store_true",
+        help="Query is download folders, make PDFs of their JPEG subfolders offline",
+        gooey_options={
+            "show_help": True,
+        },
+    )
+    command.add_argument(
+        "--index",
+        dest="index",
+        action="store_true",
+        help="Query is download folders, add the docs saved in them to the local index",
+        gooey_options={
+            "show_help": True,
+        },
+    )
     parser_q.add_argument(
         "-D",
         "--download",
@@ -224,6 +290,54 @@ def cli():
             "show_label": False,
         },
     )
+    parser_s.add_argument(
+        "--local",
+        dest="local",
+        action="store_true",
+        help="Search the local --index instead of Polona.pl",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+    parser_s.add_argument(
+        "--index-db",
+        dest="index_db",
+        type=str,
+        widget="FileChooser",
+        metavar="index_file",
+        help="Local index file (default: .pypolona/index.sqlite in the download folder)",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+    parser_s.add_argument(
+        "-Y",
+        "--sync",
+        dest="sync",
+        action="store_true",
+        help="Only output and download search hits that are new since the last --sync run",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+    parser_s.add_argument(
+        "--refresh",
+        dest="refresh",
+        action="store_true",
+        help="Search Polona.pl again even if the results of this search are cached",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+    parser_s.add_argument(
+        "--search-ttl",
+        dest="search_ttl",
+        type=int,
+        default=60,
+        metavar="minutes",
+        help="Reuse the results of the same search for this many minutes (0: do not cache)",
+        gooey_options={"show_label": False, "full_width": False},
+    )
     parser_s.add_argument(
         "-d",
         "--download-dir",
@@ -232,11 +346,29 @@ def cli():
         default=str(pathlib.Path.home() / "Desktop" / "polona"),
         widget="DirChooser",
         metavar="download_folder",
-        help="Save downloaded docs in this folder",
+        help="Save downloaded docs in this folder (-: stream --format-out tar to stdout)",
         gooey_options={
             "show_label": False,
         },
     )
+    parser_s.add_argument(
+        "--layout",
+        dest="layout",
+        type=str,
+        choices=["flat", "hash", "year", "decade"],
+        default="flat",
+        help="Save docs directly in the download folder, or in subfolders by ID hash, year or decade",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_s.add_argument(
+        "--format-out",
+        dest="format_out",
+        type=str,
+        choices=["pdf", "cbz", "zip", "tar"],
+        default="pdf",
+        help="Save each doc as PDF (or JPEG folder with -i), or its JPEGs in one CBZ, ZIP or tar archive",
+        gooey_options={"show_label": False, "full_width": False},
+    )
     parser_s.add_argument(
         "-M",
         "--max-pages",
@@ -247,6 +379,32 @@ def cli():
         help="Download max pages per doc (0: all)",
         gooey_options={"show_label": False, "full_width": False},
     )
+    parser_s.add_argument(
+        "--pages",
+        dest="pages",
+        type=page_ranges,
+        metavar="page_ranges",
+        help="Download only these pages per doc, e.g. 1-5,100,-3 (-3: last 3 pages, 200-: page 200 to end)",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_s.add_argument(
+        "--every",
+        dest="every",
+        type=int,
+        default=0,
+        metavar="n",
+        help="Download only every nth of the (selected) pages per doc",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_s.add_argument(
+        "--resolution",
+        dest="resolution",
+        type=resolution,
+        default="max",
+        metavar="max|min|width",
+        help="Download the largest or smallest scan size, or the smallest one at least this many pixels wide",
+        gooey_options={"show_label": False, "full_width": False},
+    )
     parser_s.add_argument(
         "-T",
         "--no-text-pdf",
@@ -268,12 +426,259 @@ def cli():
         },
     )
 
+    parser_t = parser.add_argument_group(
+        "PDF output",
+        gooey_options={"show_border": True, "columns": 2, "margin_top": 0},
+    )
+    parser_t.add_argument(
+        "--dpi",
+        dest="dpi",
+        type=int,
+        default=0,
+        metavar="dpi",
+        help="Downscale scans to this resolution before making the PDF (0: keep)",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_t.add_argument(
+        "--color",
+        dest="color",
+        type=str,
+        choices=["keep", "gray", "bitonal", "auto"],
+        default="keep",
+        help="Convert scans to grayscale or black & white (auto: grayscale for colorless pages)",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_t.add_argument(
+        "--quality",
+        dest="quality",
+        type=int,
+        default=0,
+        metavar="quality",
+        help="Recompress scans with this JPEG quality, 1-95 (0: keep)",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_t.add_argument(
+        "--jp2",
+        dest="jp2",
+        action="store_true",
+        help="Recompress scans as JPEG 2000",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+    parser_t.add_argument(
+        "--linearize",
+        dest="linearize",
+        action="store_true",
+        help="Save PDFs linearized (fast web view) so viewers can show the first page early",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+    parser_t.add_argument(
+        "--object-streams",
+        dest="object_streams",
+        action="store_true",
+        help="Save PDFs with compressed object streams (smaller overhead)",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+    parser_t.add_argument(
+        "--deterministic",
+        dest="deterministic",
+        action="store_true",
+        help="Make the same PDF bytes for the same doc in every run, and save their SHA-256 in .sha256 files",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+    parser_t.add_argument(
+        "--merge-into",
+        dest="merge_into",
+        type=str,
+        default=None,
+        metavar="merged_pdf",
+        help="Also merge the image PDFs of all docs into this PDF, with a bookmark per doc",
+        widget="FileSaver",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_t.add_argument(
+        "--transcode-jobs",
+        dest="transcode_jobs",
+        type=int,
+        default=0,
+        metavar="num_processes",
+        help="Processes used to recompress scans (0: one per CPU)",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_p = parser.add_argument_group(
+        "Performance",
+        gooey_options={"show_border": True, "columns": 2, "margin_top": 0},
+    )
+    parser_p.add_argument(
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        metavar="num_docs",
+        help="Download this many docs at the same time, sharing the bandwidth fairly",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_p.add_argument(
+        "--limit-rate",
+        dest="limit_rate",
+        type=float,
+        default=0,
+        metavar="MB/s",
+        help="Limit the total download bandwidth to this many megabytes per second,"
+        " split evenly between --workers processes (0: no limit)",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_p.add_argument(
+        "--sjf",
+        dest="sjf",
+        action="store_true",
+        help="Download the docs with the fewest pages first",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+    parser_p.add_argument(
+        "--page-retries",
+        dest="page_retries",
+        type=int,
+        default=2,
+        metavar="num_retries",
+        help="Download a truncated or broken page again up to this many times",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_p.add_argument(
+        "--lookahead",
+        dest="lookahead",
+        type=int,
+        default=4,
+        metavar="num_docs",
+        help="Fetch the metadata of this many upcoming docs while downloading scans (0: off)",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_p.add_argument(
+        "--queue",
+        dest="queue",
+        type=str,
+        widget="FileSaver",
+        metavar="queue_file",
+        help="Download through this shared work queue; run again on other hosts to add workers",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+    parser_p.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=0,
+        metavar="num_workers",
+        help="Number of worker processes working the --queue",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_p.add_argument(
+        "--lease-time",
+        dest="lease_time",
+        type=int,
+        default=600,
+        metavar="seconds",
+        help="Hand a queued doc to another worker if its worker is silent this long",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+
+    parser_p.add_argument(
+        "--min-free",
+        dest="min_free",
+        type=int,
+        default=500,
+        metavar="megabytes",
+        help="Keep this much disk space free, postpone docs that would not fit",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_p.add_argument(
+        "--space-wait",
+        dest="space_wait",
+        type=int,
+        default=0,
+        metavar="seconds",
+        help="When no remaining doc fits on the disk, wait this long for free space",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_p.add_argument(
+        "--preallocate",
+        dest="preallocate",
+        action="store_true",
+        help="Preallocate output files before writing them",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+
+    parser_p.add_argument(
+        "--progress",
+        dest="progress",
+        type=str,
+        choices=["auto", "bar", "gooey", "none"],
+        default="auto",
+        help="Report download progress as a terminal bar or GUI progress (auto: GUI progress in the GUI, bar in a terminal)",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_p.add_argument(
+        "--status-file",
+        dest="status_file",
+        type=str,
+        widget="FileSaver",
+        metavar="status_file",
+        help="Keep updating download progress, throughput and ETA in this JSON file",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+
+    parser_p.add_argument(
+        "--serve-jobs",
+        dest="serve_jobs",
+        type=int,
+        default=2,
+        metavar="num_jobs",
+        help="Number of jobs that --serve runs at the same time",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_p.add_argument(
+        "--profile",
+        dest="profile",
+        type=str,
+        choices=["none", "cpu", "mem", "time"],
+        default="none",
+        help="Profile the run with cProfile (cpu), tracemalloc (mem) or call timers only (time)",
+        gooey_options={"show_label": False, "full_width": False},
+    )
+    parser_p.add_argument(
+        "--profile-out",
+        dest="profile_out",
+        type=str,
+        widget="FileSaver",
+        metavar="profile_file",
+        help="Save the profile here (default: .pypolona/profile-* in the download folder)",
+        gooey_options={
+            "show_label": False,
+        },
+    )
+
     parser_q.add_argument("-V", "--version", action="version", version="%s" % (version))
 
     return parser
 
 
 def main(*args, **kwargs):
+    # Child processes of the frozen ppolona app run their target, not the GUI
+    multiprocessing.freeze_support()
     #    if '--web' in sys.argv:
     #        sys.argv.pop(sys.argv.index('--web'))
     #        parser = webgui(*args, **kwargs)
@@ -283,7 +688,10 @@ def main(*args, **kwargs):
     opts = parser.parse_args()
     if opts:
         opts = vars(opts)
-        Polona(**opts)
+        if opts.get("serve"):
+            serve(opts["query"][0], parser.parse_args, opts["serve_jobs"])
+        else:
+            Polona(**opts).run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+pypolona.archive
+----------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Archive outputs for `--format-out cbz|zip|tar`: the files of the
+`--images` layout (`<subdir>/<id>-NNNN.jpg`, `<subdir>/<id>.yaml`) are
+streamed into a single container as the pages are downloaded.
+"""
+
+import abc
+import io
+import logging
+import os
+import sys
+import tarfile
+import time
+import zipfile
+
+log = logging.getLogger("pypolona")
+
+ARCHIVE_FORMATS = ("cbz", "zip", "tar")
+
+
+class Archive(abc.ABC):
+    """Write-only container. A file is written to `<path>.part` first and
+    only renamed to `path` when it is closed, so that unfinished archives
+    are never mistaken for complete ones.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.part_path = None if path == "-" else path + ".part"
+
+    @abc.abstractmethod
+    def add(self, name, data, compress=False):
+        """Add the bytes data as the file name."""
+
+    @abc.abstractmethod
+    def _close(self):
+        """Finish writing the container."""
+
+    def close(self):
+        self._close()
+        if self.part_path:
+            os.replace(self.part_path, self.path)
+
+
+class ZipArchive(Archive):
+    """ZIP or CBZ file. JPEGs are stored as they are, other files deflated."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.zip = zipfile.ZipFile(self.part_path, "w")
+
+    def add(self, name, data, compress=False):
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        self.zip.writestr(info, data)
+
+    def _close(self):
+        self.zip.close()
+
+
+class TarArchive(Archive):
+    """Uncompressed tar file, or tar stream on stdout if path is "-"."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        if path == "-":
+            self.tar = tarfile.open(fileobj=sys.stdout.buffer, mode="w|")
+        else:
+            self.tar = tarfile.open(self.part_path, mode="w|")
+
+    def add(self, name, data, compress=False):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def _close(self):
+        self.tar.close()
+        if self.path == "-":
+            sys.stdout.buffer.flush()
+
+
+def open_archive(kind, path):
+    """Open a new archive of kind (see ARCHIVE_FORMATS) at path; "-" is stdout."""
+    if kind == "tar":
+        return TarArchive(path)
+    if path == "-":
+        raise ValueError("Only tar archives can be written to stdout")
+    return ZipArchive(path)
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+pypolona.client
+---------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Reusable, side-effect-free access to the Polona.pl API.
+
+```python
+from pypolona.client import PolonaClient
+
+client = PolonaClient()
+for hit in client.iter_search("Sienkiewicz", languages=["polski"]):
+    item = client.get_item(hit.id)
+    pages = [data for idx, data in client.iter_pages(item, range(3)) if data]
+    pdf = client.build_pdf(item, pages)
+```
+
+One client keeps one pool of HTTP connections for all its requests, so
+long-running programs should create it once and reuse it. It is safe to
+share between threads: concurrent requests for the same URL or item are
+merged into one, and items and small responses are kept in memory.
+"""
+
+import logging
+import mimetypes
+import time
+import urllib.parse
+
+import dateutil.parser
+import html2text
+import lxml2json
+import requests
+from lxml import etree
+from orderedattrdict import AttrDict as ad
+
+try:
+    from .memo import LRUCache, SingleFlight
+except ImportError:
+    from pypolona.memo import LRUCache, SingleFlight
+try:
+    from .profiling import timed
+except ImportError:
+    from pypolona.profiling import timed
+try:
+    from .verify import jpeg_problem, jpeg_size
+except ImportError:
+    from pypolona.verify import jpeg_problem, jpeg_size
+try:
+    from .pdfmeta import add_meta, images_to_pdf
+except ImportError:
+    from pypolona.pdfmeta import add_meta, images_to_pdf
+
+log = logging.getLogger("pypolona")
+
+API_URL = "https://polona.pl/api/entities/"
+
+# Bytes read at a time from responses under a bandwidth limit
+CHUNK_SIZE = 64 * 1024
+
+# Responses up to this size can be kept in the in-memory response cache
+MEMO_MAX_BYTES = 256 * 1024
+
+
+def _requests_encode_dict(dic, name):
+    url = ""
+    for k, v in dic.items():
+        fragm = f"{name}[{k}]"
+        if type(v) == type([]):
+            for i in v:
+                url += f"&{fragm}[]={i}"
+        else:
+            url += f"&{fragm}={v}"
+    return url
+
+
+def select_scan_resource(resources, resolution="max"):
+    """Pick the one JPEG rendition of a scan to download.
+
+    `resolution` is "max", "min" or a target width in pixels, which selects
+    the smallest rendition at least that wide (or the largest one if none
+    is). Renditions are compared by their width, height or size; if the
+    API gives none of these, they are assumed to be listed largest first.
+    """
+    jpegs = [res for res in resources if res.get("mime") == "image/jpeg"]
+    if len(jpegs) < 2:
+        return jpegs[0] if jpegs else None
+    sizes = [_resource_size(res) for res in jpegs]
+    if None in sizes:
+        sizes = list(range(len(jpegs), 0, -1))
+    by_size = sorted(zip(sizes, range(len(jpegs))))
+    if resolution == "max":
+        return jpegs[by_size[-1][1]]
+    if resolution == "min":
+        return jpegs[by_size[0][1]]
+    for size, idx in by_size:
+        if size >= int(resolution):
+            return jpegs[idx]
+    return jpegs[by_size[-1][1]]
+
+
+def _resource_size(res):
+    for key in ("width", "height", "size"):
+        try:
+            return int(res[key])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return None
+
+
+class PolonaClient:
+    def __init__(self, session=None, pool_size=10, cache_size=128, memo_size=256):
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+        self.items = LRUCache(cache_size)
+        self.responses = LRUCache(memo_size)
+        self.flights = SingleFlight()
+        # Seconds before the first retry of a broken scan
+        self.retry_delay = 1.0
+
+    def get(self, url, memo=False, limiter=None, **kwargs):
+        """GET url with its body read. Concurrent GETs of the same URL share
+        one request; with `memo`, small successful responses are cached.
+        With a throttle.RateLimiter `limiter`, the body is read in chunks
+        that each wait for their share of the bandwidth.
+        """
+        if memo:
+            r = self.responses.get(url)
+            if r is not None:
+                return r
+        r = self.flights.do(("GET", url), lambda: self._get(url, limiter, **kwargs))
+        if memo and r.ok and len(r.content) <= MEMO_MAX_BYTES:
+            self.responses.put(url, r)
+        return r
+
+    def _get(self, url, limiter=None, **kwargs):
+        log.debug(url)
+        if limiter is None:
+            r = self.session.get(url, **kwargs)
+            r.content
+            return r
+        r = self.session.get(url, **{**kwargs, "stream": True})
+        chunks = []
+        for chunk in r.iter_content(CHUNK_SIZE):
+            # Not reading the socket while waiting slows the sender down
+            limiter.consume(len(chunk))
+            chunks.append(chunk)
+        r._content = b"".join(chunks)
+        return r
+
+    def head(self, url, **kwargs):
+        return self.session.head(url, **kwargs)
+
+    def _json(self, r):
+        try:
+            return ad(r.json())
+        except ValueError:
+            h = html2text.HTML2Text()
+            log.critical(h.handle(r.text))
+            return None
+
+    def search_url(
+        self, query, sort="score desc", languages=None, advanced=False, size=150
+    ):
+        if not isinstance(query, str):
+            query = " ".join(query)
+        filters = {"public": 1}
+        if languages:
+            filters["language"] = languages
+        params = {
+            "query": query,
+            "sort": sort,
+            "size": size,
+        }
+        if advanced:
+            params["advanced"] = 1
+        urlparams = urllib.parse.urlencode(params) + _requests_encode_dict(
+            filters, "filters"
+        )
+        return API_URL + "?" + urlparams
+
+    def iter_search_url(self, query_url):
+        """Yield the hits of the search at query_url."""
+        jhits = self._json(self.get(query_url))
+        if not jhits:
+            return
+        for jhit in jhits.get("hits", ad()):
+            jhit = ad(jhit)
+            if jhit.get("id"):
+                hit = ad()
+                hit.id = jhit.id
+                hit.title = jhit.get("title")
+                hit.slug = jhit.get("slug")
+                year = jhit.get("date")
+                if year:
+                    hit.year = dateutil.parser.parse(year).year
+                hit.url = f"https://polona.pl/item/{hit.slug},{hit.id}/"
+                yield hit
+
+    def iter_search_all(self, query_url):
+        """Yield the hits of all result pages of the search at query_url.
+
+        Pages are requested with a `from` offset until one comes back with
+        fewer hits than its `size`. A page without new hits also ends the
+        search, in case the API ignores the offset.
+        """
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(query_url).query))
+        size = int(params.get("size", 150))
+        seen = set()
+        offset = 0
+        while True:
+            url = query_url + ("&from=%d" % offset if offset else "")
+            count = 0
+            new = 0
+            for hit in self.iter_search_url(url):
+                count += 1
+                if hit.id not in seen:
+                    seen.add(hit.id)
+                    new += 1
+                    yield hit
+            if count < size or not new:
+                break
+            offset += count
+
+    def iter_search(self, query, **kwargs):
+        """Yield the hits of a search, see search_url() for the arguments."""
+        return self.iter_search_url(self.search_url(query, **kwargs))
+
+    def get_item(self, id):
+        """Return the entity of id with its DC record, or None."""
+        hit = self.items.get(id)
+        if hit is None:
+            hit = self.flights.do(("item", id), lambda: self._fetch_item(id))
+        return hit
+
+    def _fetch_item(self, id):
+        hit = self._json(self.get(API_URL + id))
+        if hit and hit.get("id"):
+            hit = self._process_hit(hit)
+            hit.textpdf_url = None
+            hit.dc_url = None
+            if hit.get("resources"):
+                hit = self._process_resources(hit)
+            self.items.put(id, hit)
+        return hit
+
+    def _process_hit(self, hit):
+        hit.subdir = []
+        year = hit.get("date")
+        if year:
+            hit.year = dateutil.parser.parse(year).year
+            hit.subdir.append("%s-" % hit.year)
+        hit.subdir.append(hit.slug[:64])
+        hit.subdir.append("-%s" % hit.id)
+        hit.subdir = "-".join(hit.subdir)
+        hit.url = f"https://polona.pl/item/{hit.slug},{hit.id}/"
+        return hit
+
+    @timed
+    def _process_dc(self, hit):
+        r = self.get(hit.dc_url, memo=True, stream=True)
+        if ".xml" in mimetypes.guess_all_extensions(
+            r.headers.get("content-type", "").split(";")[0]
+        ):
+            dc_root = lxml2json.convert(
+                etree.XML(r.content)[0],
+                ordered=True,
+                alwaysList=[
+                    ".//language",
+                    ".//country",
+                    ".//contributor",
+                    ".//creator",
+                    ".//subject",
+                    ".//tags",
+                ],
+            )
+            dc = dc_root.get(
+                "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description", {}
+            )
+            if len(dc.keys()):
+                hit.dc = dc
+        return hit
+
+    def _process_resources(self, hit):
+        for resource in hit.resources:
+            if ".pdf" in mimetypes.guess_all_extensions(resource.get("mime", "")):
+                hit.textpdf_url = resource.get("url", None)
+            if ".xml" in mimetypes.guess_all_extensions(resource.get("mime", "")):
+                hit.dc_url = resource.get("url", None)
+                if hit.dc_url:
+                    hit = self._process_dc(hit)
+        return hit
+
+    def content_length(self, url):
+        try:
+            r = self.head(url, allow_redirects=True, timeout=30)
+        except requests.RequestException:
+            return None
+        if r.ok and r.headers.get("content-length", "").isdigit():
+            return int(r.headers["content-length"])
+        return None
+
+    @timed
+    def download_scan(self, url, width=None, height=None, limiter=None):
+        """Return the JPEG at url, or None if it is not a whole JPEG.
+
+        `width` and `height` are the size listed by the API, which is only
+        compared with the size of the JPEG to log a warning.
+        """
+        try:
+            r = self.get(url, limiter=limiter, stream=True)
+        except requests.RequestException as e:
+            log.warning("Cannot download %s: %s" % (url, e))
+            return None
+        if ".jpg" not in mimetypes.guess_all_extensions(
+            r.headers.get("content-type", "")
+        ):
+            log.warning("%s is not a JPEG" % url)
+            return None
+        length = r.headers.get("content-length")
+        if r.headers.get("content-encoding") or not str(length or "").isdigit():
+            length = None
+        problem = jpeg_problem(r.content, int(length) if length else None)
+        if problem:
+            log.warning("%s: %s" % (url, problem))
+            return None
+        size = jpeg_size(r.content)
+        if width and height and size != (int(width), int(height)):
+            log.warning(
+                "%s is %dx%d, expected %sx%s" % (url, size[0], size[1], width, height)
+            )
+        return r.content
+
+    @timed
+    def download_textpdf(self, url, limiter=None):
+        r = self.get(url, limiter=limiter, stream=True)
+        if ".pdf" in mimetypes.guess_all_extensions(r.headers.get("content-type", "")):
+            return r.content
+        else:
+            return None
+
+    def scan_url(self, scan, resolution="max"):
+        res = select_scan_resource(scan["resources"], resolution)
+        return res["url"] if res else None
+
+    def iter_pages(
+        self, item, indices=None, resolution="max", retries=2, limiter=None
+    ):
+        """Yield (index, JPEG bytes or None) for the scans of item.
+
+        A scan that does not arrive as a whole JPEG is downloaded again up
+        to `retries` times, waiting `retry_delay` seconds more each time.
+        The scans are downloaded under the bandwidth `limiter`, if given.
+        """
+        if indices is None:
+            indices = range(len(item.scans))
+        for idx in indices:
+            res = select_scan_resource(item.scans[idx]["resources"], resolution)
+            if not res:
+                log.error("No JPEG scan for page %d of %s" % (idx + 1, item.id))
+                yield idx, None
+                continue
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(self.retry_delay * attempt)
+                img = self.download_scan(
+                    res["url"], res.get("width"), res.get("height"), limiter
+                )
+                if img:
+                    break
+            if not img:
+                log.error("Cannot download %s" % (res["url"]))
+            yield idx, img
+
+    @timed
+    def build_pdf(
+        self, item, pages, linearize=False, object_streams=False, deterministic=False
+    ):
+        """Return a PDF with metadata made of the page images of item.
+
+        See pdfmeta.save_options() for `linearize`, `object_streams` and
+        `deterministic`.
+        """
+        return images_to_pdf(pages, item, linearize, object_streams, deterministic)
+
+    @timed
+    def add_pdf_meta(
+        self, data, item, linearize=False, object_streams=False, deterministic=False
+    ):
+        """Return the PDF bytes data with the metadata of item."""
+        return add_meta(data, item, linearize, object_streams, deterministic)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+pypolona.index
+--------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Local full-text index (SQLite FTS5) of the metadata of downloaded items,
+for `--index` and `-S --local`.
+"""
+
+import logging
+import os
+import os.path
+import sqlite3
+
+import dateutil.parser
+from orderedattrdict import AttrDict as ad
+
+try:
+    from .library import iter_library, read_sidecar
+except ImportError:
+    from pypolona.library import iter_library, read_sidecar
+
+log = logging.getLogger("pypolona")
+
+SORT_ORDER = {
+    "score desc": "rank",
+    "date desc": "items.year DESC, rank",
+    "date asc": "items.year ASC, rank",
+    "title asc": "items.title COLLATE NOCASE ASC",
+    "creator asc": "items_fts.creator COLLATE NOCASE ASC",
+}
+
+
+def _texts(value):
+    """Flatten strings, lists and DC {"text": ...} nodes into a list of str."""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [text for v in value for text in _texts(v)]
+    if isinstance(value, dict):
+        return _texts(value.get("text"))
+    return [str(value).strip()]
+
+
+def item_fields(hit):
+    """Return the searchable text fields of a Polona entity."""
+    dc = hit.get("dc", None) or {}
+    creator = _texts(hit.get("creator_name")) or _texts(hit.get("creator"))
+    creator += _texts(hit.get("contributor")) + _texts(dc.get("creator"))
+    subjects = []
+    for key in ("subject", "keywords", "categories", "metatypes", "projects"):
+        subjects += _texts(hit.get(key))
+    subjects += _texts(dc.get("tags")) + _texts(dc.get("subject"))
+    dates = _texts(hit.get("date")) + _texts(hit.get("date_descriptive"))
+    other = []
+    for key in ("publisher", "imprint", "publish_place", "series", "press_title"):
+        other += _texts(hit.get(key))
+    for key in ("notes", "physical_description"):
+        other += _texts(hit.get(key))
+    languages = _texts(dc.get("language")) + _texts(hit.get("language"))
+    return {
+        "title": " ".join(_texts(hit.get("title"))),
+        "creator": "; ".join(dict.fromkeys(creator)),
+        "subjects": "; ".join(dict.fromkeys(subjects)),
+        "dates": "; ".join(dates),
+        "other": "; ".join(other),
+        "languages": "|%s|" % "|".join(sorted(set(languages))),
+    }
+
+
+def fts_query(query, advanced=False):
+    """Turn a -S query into an FTS5 query; -A queries use FTS5 syntax as is."""
+    if advanced:
+        return query
+    return " ".join('"%s"' % word.replace('"', '""') for word in query.split())
+
+
+class MetadataIndex:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                id TEXT PRIMARY KEY,
+                title TEXT,
+                slug TEXT,
+                year INTEGER,
+                url TEXT,
+                path TEXT,
+                languages TEXT,
+                mtime REAL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+                id UNINDEXED, title, creator, subjects, dates, other,
+                tokenize = 'unicode61 remove_diacritics 2'
+            );
+            """
+        )
+
+    def add(self, hit, path=None, mtime=None):
+        fields = item_fields(hit)
+        year = hit.get("year", None)
+        if not year and hit.get("date", None):
+            try:
+                year = dateutil.parser.parse(hit["date"]).year
+            except (ValueError, OverflowError):
+                year = None
+        self.db.execute("DELETE FROM items_fts WHERE id = ?", (hit["id"],))
+        self.db.execute(
+            "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                hit["id"],
+                fields["title"],
+                hit.get("slug", None),
+                year,
+                hit.get("url", None)
+                or "https://polona.pl/item/%s,%s/" % (hit.get("slug", ""), hit["id"]),
+                path,
+                fields["languages"],
+                mtime,
+            ),
+        )
+        self.db.execute(
+            "INSERT INTO items_fts VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                hit["id"],
+                fields["title"],
+                fields["creator"],
+                fields["subjects"],
+                fields["dates"],
+                fields["other"],
+            ),
+        )
+
+    def ingest(self, root):
+        """Add the sidecars of the items under root, return the number added.
+
+        Sidecars that have not changed since they were indexed are skipped.
+        """
+        mtimes = dict(self.db.execute("SELECT path, mtime FROM items"))
+        count = 0
+        for item in iter_library(root):
+            if not item.sidecar:
+                continue
+            mtime = os.path.getmtime(item.sidecar)
+            if mtimes.get(item.path) == mtime:
+                continue
+            hit = read_sidecar(item.sidecar)
+            if hit:
+                self.add(hit, item.path, mtime)
+                count += 1
+        self.db.commit()
+        return count
+
+    def search(self, query, sort="score desc", languages=None, advanced=False):
+        """Return the hits matching query, like PolonaClient.iter_search()."""
+        sql = (
+            "SELECT items.id, items.title, items.slug, items.year, items.url"
+            " FROM items_fts JOIN items ON items.id = items_fts.id"
+            " WHERE items_fts MATCH ?"
+        )
+        params = [fts_query(query, advanced)]
+        if languages:
+            sql += " AND (%s)" % " OR ".join(["items.languages LIKE ?"] * len(languages))
+            params += ["%%|%s|%%" % language for language in languages]
+        sql += " ORDER BY " + SORT_ORDER.get(sort, "rank")
+        hits = []
+        for id, title, slug, year, url in self.db.execute(sql, params):
+            hit = ad()
+            hit.id = id
+            hit.title = title
+            hit.slug = slug
+            if year:
+                hit.year = year
+            hit.url = url
+            hits.append(hit)
+        return hits
+
+    def get(self, id):
+        row = self.db.execute(
+            "SELECT path FROM items WHERE id = ?", (id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        self.db.close()
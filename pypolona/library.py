@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+pypolona.library
+----------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Reading an existing download folder: the items saved in it and their
+YAML sidecars with the Polona entity metadata.
+
+An item saved as PDF is `<subdir>.pdf` with the sidecar `<subdir>.yaml`.
+An item saved with `--images` is the folder `<subdir>` with `<id>.yaml`
+and the pages `<id>-NNNN.jpg` inside. `<subdir>` always ends with `-<id>`.
+With a sharded `--layout`, items are saved in subfolders of the download
+folder, and `.pypolona/paths.tsv` lists the saved paths by ID.
+"""
+
+import hashlib
+import logging
+import os
+import os.path
+import threading
+
+from orderedattrdict import AttrDict as ad
+from yaplon import oyaml
+
+try:
+    from .storage import write_file
+except ImportError:
+    from pypolona.storage import write_file
+
+log = logging.getLogger("pypolona")
+
+
+def write_sidecar(path, hit):
+    write_file(path, oyaml.yaml_dump(hit).encode("utf-8"))
+
+
+def read_sidecar(path):
+    """Return the hit stored in the sidecar at path, or None."""
+    try:
+        with open(path, encoding="utf-8") as yamlfile:
+            hit = oyaml.read_yaml(yamlfile)
+    except Exception as e:
+        log.error("Cannot read file://%s: %s" % (path, e))
+        return None
+    if not isinstance(hit, dict) or not hit.get("id"):
+        return None
+    return ad(hit)
+
+
+def iter_library(root):
+    """Yield the items saved under root as ad(id, kind, path, sidecar).
+
+    kind is "pdf" or "folder". Folders starting with "." are skipped.
+    PDFs saved before sidecars were written next to them have no sidecar.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        folder_id = os.path.basename(dirpath).rsplit("-", 1)[-1]
+        names = set(filenames)
+        for name in sorted(filenames):
+            base, ext = os.path.splitext(name)
+            path = os.path.join(dirpath, name)
+            if ext == ".yaml" and base == folder_id:
+                yield ad(id=base, kind="folder", path=dirpath, sidecar=path)
+            elif ext == ".yaml" and "-" in base:
+                yield ad(
+                    id=base.rsplit("-", 1)[-1],
+                    kind="pdf",
+                    path=os.path.join(dirpath, base + ".pdf"),
+                    sidecar=path,
+                )
+            elif (
+                ext == ".pdf"
+                and "-" in base
+                and not base.endswith("_text")
+                and base + ".yaml" not in names
+                and base.rsplit("-", 1)[-1] != folder_id
+            ):
+                yield ad(id=base.rsplit("-", 1)[-1], kind="pdf", path=path, sidecar=None)
+
+
+LAYOUTS = ("flat", "hash", "year", "decade")
+
+
+def shard_dir(hit, layout="flat"):
+    """Return the subfolder of the download folder for hit in layout."""
+    if layout == "hash":
+        return hashlib.sha1(hit["id"].encode("utf-8")).hexdigest()[:2]
+    if layout in ("year", "decade"):
+        year = hit.get("year", None)
+        if not year:
+            return "undated"
+        if layout == "decade":
+            return "%ds" % (int(year) // 10 * 10)
+        return str(year)
+    return ""
+
+
+class PathIndex:
+    """Append-only file of `<id>\t<path>` lines for the saved items.
+
+    Paths are relative to the download folder. The file is read once, so
+    existence checks need no filesystem access.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.paths = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as index:
+                for line in index:
+                    id, _, item_path = line.rstrip("\n").partition("\t")
+                    if item_path:
+                        self.ids.setdefault(id, []).append(item_path)
+                        self.paths.add(item_path)
+
+    def __contains__(self, item_path):
+        return item_path in self.paths
+
+    def get(self, id):
+        return self.ids.get(id, [])
+
+    def add(self, id, item_path):
+        with self.lock:
+            if item_path in self.paths:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Short appends are atomic, so several workers can share the file
+            with open(self.path, "a", encoding="utf-8") as index:
+                index.write("%s\t%s\n" % (id, item_path))
+            self.ids.setdefault(id, []).append(item_path)
+            self.paths.add(item_path)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+pypolona.memo
+-------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+In-process caching for PolonaClient: a thread-safe LRU and single-flight
+coalescing of concurrent identical requests.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class LRUCache:
+    """Thread-safe mapping that keeps the `size` most recently used entries."""
+
+    def __init__(self, size=128):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SingleFlight:
+    """Run each function only once for concurrent callers with the same key.
+
+    The first caller of `do(key, func)` runs func; callers that arrive with
+    the same key while it runs wait for it and get its result (or its
+    exception) instead of running func again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.shared = 0
+
+    def do(self, key, func):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return future.result()
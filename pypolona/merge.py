@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+pypolona.merge
+--------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+`--merge-into`: one PDF made of the image PDFs of all downloaded docs,
+with a bookmark per doc, e.g. for the issues of a periodical.
+"""
+
+import logging
+import os
+import os.path
+import threading
+
+import pikepdf
+
+try:
+    from .pdfmeta import save_options
+except ImportError:
+    from pypolona.pdfmeta import save_options
+
+log = logging.getLogger("pypolona")
+
+# Docs merged between two saves of the partial merged PDF
+MERGE_BATCH = 64
+
+
+def bookmark_title(hit):
+    """Return the bookmark title of a doc: its title and date."""
+    title = hit.get("title") or hit.id
+    date = hit.get("date")
+    return "%s (%s)" % (title, date) if date else title
+
+
+class PdfMerger:
+    """Merges the saved PDFs of docs into one PDF as they are saved.
+
+    The docs follow the order of `ids`: a doc is merged as soon as all
+    docs before it have been, the others wait (as paths) until then or
+    until close(). The pages are copied from the PDF files by reference,
+    so their images are read from disk when the merged PDF is written.
+    After every `batch` docs the merged PDF is saved to `<path>.part` and
+    reopened, so that no more than `batch` files are open at a time.
+    """
+
+    def __init__(
+        self,
+        path,
+        ids,
+        linearize=False,
+        object_streams=False,
+        deterministic=False,
+        batch=MERGE_BATCH,
+    ):
+        self.path = os.path.abspath(path)
+        self.part_path = self.path + ".part"
+        self.ids = list(ids)
+        self.order = {id: n for n, id in enumerate(self.ids)}
+        self.linearize = linearize
+        self.object_streams = object_streams
+        self.deterministic = deterministic
+        self.batch = max(batch, 1)
+        self.next = 0
+        self.docs = {}
+        self.count = 0
+        self.merged = None
+        self.sources = []
+        self.lock = threading.Lock()
+
+    def add(self, hit, pdf_path):
+        with self.lock:
+            self.docs[hit.id] = (pdf_path, hit)
+            while self.next < len(self.ids) and self.ids[self.next] in self.docs:
+                self._append(*self.docs.pop(self.ids[self.next]))
+                self.next += 1
+
+    def _append(self, pdf_path, hit):
+        if self.merged is None:
+            self.merged = pikepdf.new()
+        source = pikepdf.open(pdf_path)
+        self.sources.append(source)
+        first = len(self.merged.pages)
+        self.merged.pages.extend(source.pages)
+        with self.merged.open_outline() as outline:
+            outline.root.append(pikepdf.OutlineItem(bookmark_title(hit), first))
+        self.count += 1
+        if len(self.sources) >= self.batch:
+            self._save(self.part_path)
+            self.merged = pikepdf.open(self.part_path)
+
+    def _save(self, path, **options):
+        """Save the merged PDF to path and close it and its sources."""
+        tmp_path = self.part_path + ".tmp"
+        try:
+            self.merged.save(tmp_path, **options)
+        finally:
+            self._close_all()
+        os.replace(tmp_path, path)
+
+    def _close_all(self):
+        for pdf in self.sources + [self.merged]:
+            if pdf is not None:
+                pdf.close()
+        self.sources = []
+        self.merged = None
+
+    def close(self):
+        """Write the merged PDF, return the number of docs in it."""
+        with self.lock:
+            try:
+                # Docs saved after one that was not
+                rest = sorted(self.docs, key=lambda id: self.order.get(id, len(self.order)))
+                for id in rest:
+                    self._append(*self.docs.pop(id))
+                if not self.count:
+                    return 0
+                self.merged.docinfo["/Title"] = os.path.splitext(
+                    os.path.basename(self.path)
+                )[0]
+                self._save(
+                    self.path,
+                    **save_options(self.linearize, self.object_streams, self.deterministic),
+                )
+            finally:
+                self._close_all()
+                for path in (self.part_path, self.part_path + ".tmp"):
+                    if os.path.exists(path):
+                        os.remove(path)
+        return self.count
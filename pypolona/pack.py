@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+pypolona.pack
+-------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+`--pack`: turn `--images` folders into PDFs offline, in parallel. Each
+folder `<subdir>` becomes `<subdir>.pdf` and `<subdir>.yaml` next to it,
+as if the doc had been downloaded without `--images`.
+"""
+
+import logging
+import mmap
+import os
+import os.path
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from .library import iter_library, read_sidecar, write_sidecar
+except ImportError:
+    from pypolona.library import iter_library, read_sidecar, write_sidecar
+try:
+    from .pdfmeta import images_to_pdf
+except ImportError:
+    from pypolona.pdfmeta import images_to_pdf
+try:
+    from .storage import write_checksum, write_file
+except ImportError:
+    from pypolona.storage import write_checksum, write_file
+try:
+    from .transcode import transcode_image
+except ImportError:
+    from pypolona.transcode import transcode_image
+try:
+    from .verify import expected_pages
+except ImportError:
+    from pypolona.verify import expected_pages
+
+log = logging.getLogger("pypolona")
+
+
+def map_file(path):
+    """Return a read-only memory map of the file at path."""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def pack_folder(
+    folder,
+    id,
+    sidecar,
+    skip=False,
+    transcode=None,
+    linearize=False,
+    object_streams=False,
+    deterministic=False,
+):
+    """Build `<folder>.pdf` from the JPEGs in folder.
+
+    `transcode` are transcode_image() settings, or None to embed the JPEGs
+    as they are. With `deterministic`, the content hash of the PDF goes to
+    `<folder>.pdf.sha256`. Returns "packed", "skipped" or "failed".
+    """
+    out_path = folder + ".pdf"
+    if skip and os.path.exists(out_path):
+        return "skipped"
+    hit = read_sidecar(sidecar)
+    if not hit:
+        return "failed"
+    numbers = expected_pages(hit)
+    paths = {
+        page: os.path.join(folder, "%s-%04d.jpg" % (id, page)) for page in numbers
+    }
+    found = [page for page in numbers if os.path.exists(paths[page])]
+    if not found:
+        log.error("No pages in file://%s" % folder)
+        return "failed"
+    if len(found) < len(numbers):
+        log.warning(
+            "file://%s has %d of %d pages" % (folder, len(found), len(numbers))
+        )
+    hit.selected_pages = found
+    paths = [paths[page] for page in found]
+    pages = []
+    try:
+        # img2pdf reads the maps, the page files are not copied in between
+        pages = [map_file(path) for path in paths]
+        if transcode:
+            images = [transcode_image(page[:], **transcode) for page in pages]
+        else:
+            images = pages
+        pdf = images_to_pdf(images, hit, linearize, object_streams, deterministic)
+    except Exception as e:
+        log.error("Cannot pack file://%s: %s" % (folder, e))
+        return "failed"
+    finally:
+        for page in pages:
+            page.close()
+    write_file(out_path, pdf)
+    if deterministic:
+        write_checksum(out_path)
+    write_sidecar(folder + ".yaml", hit)
+    return "packed"
+
+
+def _pack_args(args):
+    item, settings = args
+    return pack_folder(item.path, item.id, item.sidecar, **settings)
+
+
+def pack_library(roots, processes=None, **settings):
+    """Pack all --images folders under roots in a process pool.
+
+    `settings` go to pack_folder(). Returns the counts of the results.
+    """
+    items = [
+        item
+        for root in roots
+        for item in iter_library(root)
+        if item.kind == "folder"
+    ]
+    counts = {"packed": 0, "skipped": 0, "failed": 0}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for result in pool.map(
+            _pack_args, [(item, settings) for item in items], chunksize=4
+        ):
+            counts[result] += 1
+    return counts
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+pypolona.pdfmeta
+----------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+XMP metadata of the PDFs made by pypolona, built from Polona entity JSON
+and Dublin Core records, and the options they are saved with.
+"""
+
+import hashlib
+import io
+import json
+
+import img2pdf
+import pikepdf
+
+try:
+    from .__init__ import __version__ as version
+except ImportError:
+    from pypolona.__init__ import __version__ as version
+
+# Increase when write_meta() changes, so that --retag rewrites all PDFs
+META_VERSION = 2
+# Document info key of the hash of the metadata written into a PDF
+META_HASH_KEY = "/PyPolonaMetaHash"
+
+
+def meta_hash(hit):
+    """Return a hash of the metadata that write_meta() writes for hit."""
+    data = json.dumps(hit, sort_keys=True, default=str)
+    return hashlib.sha256(("%d\n%s" % (META_VERSION, data)).encode("utf-8")).hexdigest()
+
+
+def read_meta_hash(pdf):
+    """Return the metadata hash stored by write_meta() in pdf, or None."""
+    value = pdf.docinfo.get(META_HASH_KEY, None)
+    return str(value) if value is not None else None
+
+
+class _Bag(set):
+    """A set that iterates in sorted order, so that the rdf:Bag items of
+    the XMP metadata are written in the same order in every run."""
+
+    def __iter__(self):
+        return iter(sorted(set.__iter__(self)))
+
+
+def write_meta(pdf, hit, deterministic=False):
+    """Write the XMP metadata for hit into the open pikepdf.Pdf pdf.
+
+    With `deterministic`, pikepdf does not record itself as the editor,
+    which would add the current time as `xmp:MetadataDate`, and the random
+    document ID is dropped.
+    """
+    _write_xmp(pdf, hit, deterministic)
+    pdf.docinfo[META_HASH_KEY] = meta_hash(hit)
+    if deterministic and "/ID" in pdf.trailer:
+        # Without a previous ID, both halves of the new one are derived
+        # from the content when saved with `deterministic_id`
+        del pdf.trailer.ID
+
+
+def _write_xmp(pdf, hit, deterministic=False):
+    with pdf.open_metadata(set_pikepdf_as_editor=not deterministic) as meta:
+        meta["xmp:CreatorTool"] = "PyPolona %s" % (version)
+        id = hit.get("id", None)
+        ids = []
+        if id:
+            ids.append(id)
+            meta["dc:identifier"] = hit["id"]
+        dc = hit.get("dc", {})
+        if hit.get("isbn", None):
+            meta["prism2:isbn"] = hit["isbn"]
+            ids.append(hit["isbn"])
+        if hit.get("issn", None):
+            meta["prism2:issn"] = hit["issn"]
+            ids.append(hit["issn"])
+        if hit.get("academica_id", None):
+            ids.append(hit["academica_id"])
+        if hit.get("oclc_no", None):
+            ids.append(hit["oclc_no"])
+        ids += hit.get("call_no", [])
+        meta["xmp:Identifier"] = _Bag("%s" % i for i in ids)
+        if hit.get("title", None):
+            meta["dc:title"] = hit["title"]
+        if hit.get("date", None):
+            meta["dc:date"] = [hit["date"]]
+        if hit.get("date_descriptive", None):
+            meta["prism2:timePeriod"] = [hit["date_descriptive"]]
+        if hit.get("url", None):
+            meta["dc:source"] = hit["url"]
+            meta["prism2:url"] = hit["url"]
+        author = hit.get("creator_name", None)
+        if not author:
+            author = hit.get("creator", None)
+        contributors = hit.get("contributor", None)
+        if type(contributors) is list:
+            meta["dc:contributor"] = _Bag(contributors)
+            if not author:
+                author = contributors[0]
+        if not author:
+            author = ""
+        meta["dc:creator"] = [author.replace(",", " ").replace("  ", " ")]
+        meta["dc:source"] = hit["url"]
+        dc_langs = dc.get("language", None)
+        if type(dc_langs) is list:
+            meta["dc:language"] = _Bag(s["text"].strip() for s in dc_langs)
+        rights = hit.get("rights", None)
+        if type(rights) is list:
+            rights = ";".join(rights)
+            meta["dc:rights"] = rights
+            meta["xmpRights:WebStatement"] = rights
+        categories = hit.get("categories", None)
+        if categories:
+            meta["dc:type"] = _Bag(categories)
+            meta["prism2:contentType"] = "; ".join(categories)
+        keywords = []
+        if type(hit.get("subject", None)) is list:
+            keywords += hit["subject"]
+        if type(hit.get("keywords", None)) is list:
+            keywords += hit["keywords"]
+        if type(hit.get("categories", None)) is list:
+            keywords += hit["categories"]
+        if type(hit.get("metatypes", None)) is list:
+            keywords += hit["metatypes"]
+        if type(hit.get("projects", None)) is list:
+            keywords += hit["projects"]
+        dc_tags = dc.get("tags", None)
+        if dc_tags:
+            keywords += [s["text"] for s in dc_tags]
+        keywords = sorted(set(keywords))
+        if len(keywords):
+            meta["dc:subject"] = _Bag(keywords)
+            meta["pdf:Keywords"] = "; ".join(keywords)
+        publisher = []
+        if hit.get("publisher", None):
+            publisher.append(hit["publisher"])
+        if hit.get("imprint", None):
+            publisher.append(hit["imprint"])
+        if len(publisher):
+            meta["dc:publisher"] = _Bag(publisher)
+        if hit.get("publish_place", None) or hit.get("country", None):
+            meta["prism2:location"] = ", ".join(
+                hit.get("publish_place", []) + hit.get("country", [])
+            )
+        description = []
+        if hit.get("series", None):
+            meta["prism2:seriesTitle"] = hit["series"]
+            description.append(hit["series"])
+        dc_freq = dc.get("frequency", {}).get("text", None)
+        if dc_freq:
+            meta["prism2:publishingFrequency"] = dc_freq
+            description.append(dc_freq)
+        if hit.get("press_title", None):
+            meta["prism2:publicationName"] = hit["press_title"]
+            description.append(hit["press_title"])
+        if type(hit.get("notes", None)) is list:
+            description += hit["notes"]
+        if type(hit.get("physical_description", None)) is list:
+            description += hit["physical_description"]
+        if type(hit.get("sources", None)) is list:
+            description += hit["sources"]
+        if type(hit.get("projects", None)) is list:
+            description += hit["projects"]
+        if len(description):
+            description_text = "; ".join(str(d) for d in description)
+            meta["dc:description"] = description_text
+
+
+def save_options(linearize=False, object_streams=False, deterministic=False):
+    """Return the pikepdf.Pdf.save() keyword arguments for the PDF output options.
+
+    `linearize` enables fast web view (the first page can be shown before
+    the whole file is loaded); `object_streams` packs the PDF objects into
+    compressed object streams, which shrinks the overhead of long documents;
+    `deterministic` derives the document ID from the content instead of
+    making a random one.
+    """
+    options = {"linearize": bool(linearize), "deterministic_id": bool(deterministic)}
+    if object_streams:
+        options["object_stream_mode"] = pikepdf.ObjectStreamMode.generate
+        options["compress_streams"] = True
+    return options
+
+
+def add_meta(data, hit, linearize=False, object_streams=False, deterministic=False):
+    """Return the PDF bytes data with the metadata of hit."""
+    pdf = pikepdf.open(io.BytesIO(data))
+    write_meta(pdf, hit, deterministic)
+    out = io.BytesIO()
+    pdf.save(out, **save_options(linearize, object_streams, deterministic))
+    return out.getvalue()
+
+
+def images_to_pdf(
+    pages, hit, linearize=False, object_streams=False, deterministic=False
+):
+    """Return a PDF with the metadata of hit made of the page images.
+
+    With `deterministic`, the same pages and metadata always give the same
+    bytes: img2pdf writes no creation date and the ID is not random.
+    """
+    data = img2pdf.convert(list(pages), nodate=bool(deterministic))
+    return add_meta(data, hit, linearize, object_streams, deterministic)
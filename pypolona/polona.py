@@ -6,22 +6,23 @@ Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
 MIT license. Python 3.8+
 """
 
+import contextlib
 import json
 import logging
-import mimetypes
+import multiprocessing
 import os
 import os.path
 import re
+import shutil
+import signal
+import socket
+import sqlite3
 import sys
-import urllib.parse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import dateutil.parser
-import html2text
-import img2pdf
-import lxml2json
 import pikepdf
-import requests
-from lxml import etree
 from orderedattrdict import AttrDict as ad
 
 from yaplon import oyaml
@@ -36,22 +37,256 @@ logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("pypolona")
 
 try:
-    from .__init__ import __version__ as version
+    from .sync import SyncState, search_key
 except ImportError:
-    from pypolona.__init__ import __version__ as version
+    from pypolona.sync import SyncState, search_key
+try:
+    from .workqueue import LeaseKeeper, open_queue
+except ImportError:
+    from pypolona.workqueue import LeaseKeeper, open_queue
+try:
+    from .storage import (
+        NotEnoughSpace,
+        format_size,
+        free_space,
+        write_checksum,
+        write_file,
+    )
+except ImportError:
+    from pypolona.storage import (
+        NotEnoughSpace,
+        format_size,
+        free_space,
+        write_checksum,
+        write_file,
+    )
+try:
+    from .progress import make_progress
+except ImportError:
+    from pypolona.progress import make_progress
+try:
+    from .transcode import Transcoder
+except ImportError:
+    from pypolona.transcode import Transcoder
+try:
+    from .client import PolonaClient
+except ImportError:
+    from pypolona.client import PolonaClient
+try:
+    from .pdfmeta import save_options, write_meta
+except ImportError:
+    from pypolona.pdfmeta import save_options, write_meta
+try:
+    from .library import PathIndex, shard_dir, write_sidecar
+except ImportError:
+    from pypolona.library import PathIndex, shard_dir, write_sidecar
+try:
+    from .archive import ARCHIVE_FORMATS, open_archive
+except ImportError:
+    from pypolona.archive import ARCHIVE_FORMATS, open_archive
+try:
+    from .profiling import profile_call, timed
+except ImportError:
+    from pypolona.profiling import profile_call, timed
+try:
+    from .verify import jpeg_complete, verify_library
+except ImportError:
+    from pypolona.verify import jpeg_complete, verify_library
+try:
+    from .pack import pack_library
+except ImportError:
+    from pypolona.pack import pack_library
+try:
+    from .retag import retag_library
+except ImportError:
+    from pypolona.retag import retag_library
+try:
+    from .merge import PdfMerger
+except ImportError:
+    from pypolona.merge import PdfMerger
+try:
+    from .searchcache import SearchCache, user_cache_dir
+except ImportError:
+    from pypolona.searchcache import SearchCache, user_cache_dir
+try:
+    from .throttle import RateLimiter
+except ImportError:
+    from pypolona.throttle import RateLimiter
+try:
+    from .index import MetadataIndex
+except ImportError:
+    from pypolona.index import MetadataIndex
+
+DEFAULT_OPTS = {
+    "sync": False,
+    "queue": None,
+    "workers": 0,
+    "lease_time": 600,
+    "min_free": 500,
+    "space_wait": 0,
+    "preallocate": False,
+    "progress": "auto",
+    "status_file": None,
+    "pages": None,
+    "every": 0,
+    "resolution": "max",
+    "dpi": 0,
+    "color": "keep",
+    "quality": 0,
+    "jp2": False,
+    "transcode_jobs": 0,
+    "index": False,
+    "local": False,
+    "index_db": None,
+    "linearize": False,
+    "object_streams": False,
+    "format_out": "pdf",
+    "profile": "none",
+    "profile_out": None,
+    "verify": False,
+    "serve": False,
+    "serve_jobs": 2,
+    "emit_results": True,
+    "lookahead": 4,
+    "retag": False,
+    "pack": False,
+    "layout": "flat",
+    "jobs": 1,
+    "limit_rate": 0,
+    "sjf": False,
+    "page_retries": 2,
+    "merge_into": None,
+    "deterministic": False,
+    "search_ttl": 60,
+    "search_cache_dir": None,
+    "refresh": False,
+}
+
+# Page size estimates used by the free space check
+MAX_PAGE_SIZE = 8 * 1024 * 1024
+DEFAULT_PAGE_SIZE = 2 * 1024 * 1024
+
+
+def parse_page_ranges(spec):
+    """Parse a --pages spec like `1-5,100,-3,200-` into (first, last) ranges.
+
+    Pages are numbered from 1. `-N` means the last N pages and `N-` means
+    page N to the end; an open end is returned as None.
+    """
+    ranges = []
+    for part in spec.replace(" ", "").split(","):
+        mo = re.match(r"^(?:(\d+)|(\d+)-(\d*)|-(\d+))$", part)
+        if not mo:
+            raise ValueError("Invalid page range: %r" % part)
+        single, first, last, tail = mo.groups()
+        if single:
+            ranges.append((int(single), int(single)))
+        elif first:
+            ranges.append((int(first), int(last) if last else None))
+        else:
+            ranges.append((-int(tail), None))
+    return ranges
+
+
+def select_pages(count, ranges=None, every=0, max_pages=0):
+    """Return the 0-based indices of the pages to download out of `count`."""
+    if ranges:
+        selected = set()
+        for first, last in ranges:
+            if first < 0:
+                first = count + first + 1
+            if last is None:
+                last = count
+            selected.update(range(max(first, 1) - 1, min(last, count)))
+        indices = sorted(selected)
+    else:
+        indices = list(range(count))
+    if every > 1:
+        indices = indices[::every]
+    if max_pages > 0:
+        indices = indices[:max_pages]
+    return indices
+
+
+class Cancelled(Exception):
+    """The run was stopped by Ctrl-C, SIGTERM or the Stop button."""
 
 
 class Polona:
-    def __init__(self, **opts):
+    """Search and download run configured by the options of the ppolona CLI.
+
+    Creating the object has no side effects; `run()` performs the run.
+    """
+
+    def __init__(self, client=None, **opts):
         log.debug(opts)
-        self.o = ad(opts)
+        self.o = ad({**DEFAULT_OPTS, **opts})
+        self.client = client or PolonaClient(pool_size=max(10, 2 * self.o.jobs))
+        # The client may be shared by several runs, the limit is per run
+        self.limiter = None
+        if self.o.limit_rate:
+            self.limiter = RateLimiter(self.o.limit_rate * 1024 * 1024)
         self.ids = []
         self.hits = None
         self.dldir = None
+        self.paths = None
+        self.done_ids = []
+        # Items that --sjf fetched ahead, kept for the run as the client's
+        # item cache may not hold them all
+        self.items = {}
+        self.sync_state = None
+        progress = self.o.progress
+        if self._to_stdout() and progress in ("auto", "gooey"):
+            # Progress lines would end up in the tar stream
+            progress = "bar" if sys.stderr.isatty() else "none"
+        self.meter = make_progress(progress, self.o.status_file)
+        self.archive = None
+        self.merger = None
+        self.transcoder = None
+        # Set to stop downloading after the pages in flight
+        self.cancelled = threading.Event()
+        if self.o.dpi or self.o.color != "keep" or self.o.quality or self.o.jp2:
+            self.transcoder = Transcoder(
+                processes=self.o.transcode_jobs or None,
+                dpi=self.o.dpi,
+                color=self.o.color,
+                quality=self.o.quality,
+                jp2=self.o.jp2,
+            )
+
+    def run(self):
+        if self.o.profile == "none":
+            return self._run()
+        ext = "prof" if self.o.profile == "cpu" else "txt"
+        out_path = os.path.abspath(
+            self.o.profile_out
+            or os.path.join(self._meta_dir(), "profile-%s.%s" % (self.o.profile, ext))
+        )
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        return profile_call(self.o.profile, self._run, out_path)
+
+    def _run(self):
+        if self.o.index:
+            self.build_index()
+            return
+        if self.o.verify:
+            self.verify()
+            return
+        if self.o.retag:
+            self.retag()
+            return
+        if self.o.pack:
+            self.pack()
+            return
         if self.o.ids:
             self.ids = self.o.query
         elif self.o.search or self.o.advanced:
-            self.search()
+            if self.o.local:
+                self.search_local()
+            else:
+                self.search()
+            if self.o.sync:
+                self.sync_search()
             if self.o.download:
                 if self.o.output:
                     self.save_search_results()
@@ -60,8 +295,24 @@ class Polona:
         else:
             self.parse_urls(self.o.query)
         if self.o.download:
-            self.download()
-            log.success("Finished downloading into file://%s" % self.o.download_dir)
+            try:
+                with self.cancel_on_signals():
+                    self.download()
+            except Cancelled:
+                log.warning(
+                    "Stopped. Run the same command again to continue where it stopped."
+                )
+            self.meter.close()
+            if self.transcoder:
+                self.transcoder.close()
+                log.info(
+                    "Transcoding saved %s in total"
+                    % format_size(self.transcoder.bytes_in - self.transcoder.bytes_out)
+                )
+            if not self.cancelled.is_set():
+                log.success("Finished downloading into file://%s" % self.o.download_dir)
+        if self.sync_state:
+            self.sync_commit()
 
     def parse_urls(self, urls):
         RE_URL = r"^https://polona\.pl/item/.*?,([A-Za-z0-9]+)/.*"
@@ -70,56 +321,151 @@ class Polona:
             if mo:
                 self.ids.append(mo.group(1))
 
-    def _requests_encode_dict(self, dic, name):
-        url = ""
-        for k, v in dic.items():
-            fragm = f"{name}[{k}]"
-            if type(v) == type([]):
-                for i in v:
-                    url += f"&{fragm}[]={i}"
-            else:
-                url += f"&{fragm}={v}"
-        return url
+    def _search_url(self):
+        return self.client.search_url(
+            self.o.query,
+            sort=self.o.sort,
+            languages=self.o.search_languages,
+            advanced=self.o.advanced,
+        )
 
+    @timed
     def search(self):
-        filters = {"public": 1}
-        if self.o.search_languages:
-            filters["language"] = self.o.search_languages
-        params = {
-            "query": " ".join(self.o.query),
-            "sort": self.o.sort,
-            "size": 150,
-        }
-        if self.o.advanced:
-            params["advanced"] = 1
-        url = "https://polona.pl/api/entities/"
-        urlparams = urllib.parse.urlencode(params) + self._requests_encode_dict(
-            filters, "filters"
-        )
-        log.debug(url + "?" + urlparams)
-        r = requests.get(url + "?" + urlparams)
-        jhits = None
-        try:
-            jhits = ad(r.json())
-        except:
-            h = html2text.HTML2Text()
-            log.critical(h.handle(r.text))
         self.ids = []
-        if jhits:
-            self.hits = ad()
-            for jhit in jhits.get("hits", ad()):
-                jhit = ad(jhit)
-                if jhit.id:
-                    self.ids.append(jhit.id)
-                    hit = ad()
-                    hit.id = jhit.id
-                    hit.title = jhit.title
-                    hit.slug = jhit.slug
-                    year = jhit.date
-                    if year:
-                        hit.year = dateutil.parser.parse(year).year
-                    hit.url = f"https://polona.pl/item/{hit.slug},{hit.id}/"
-                    self.hits[jhit.id] = hit
+        self.hits = ad()
+        query_url = self._search_url()
+        cache = None
+        hits = None
+        # --sync needs the current results to find the new ones
+        if self.o.search_ttl and not self.o.sync:
+            cache = SearchCache(
+                self.o.search_cache_dir or user_cache_dir(), self.o.search_ttl * 60
+            )
+            if not self.o.refresh:
+                hits = cache.get(query_url)
+        if hits is not None:
+            log.info("Using search results cached in file://%s" % cache.path(query_url))
+        elif self.o.sync:
+            # New hits can rank anywhere, --sync needs all result pages
+            hits = list(self.client.iter_search_all(query_url))
+        else:
+            hits = list(self.client.iter_search_url(query_url))
+            if cache is not None and hits:
+                cache.put(query_url, hits)
+        for hit in hits:
+            self.ids.append(hit.id)
+            self.hits[hit.id] = hit
+
+    def _index_path(self):
+        return self.o.index_db or os.path.join(self._meta_dir(), "index.sqlite")
+
+    @timed
+    def search_local(self):
+        """Answer the search from the local --index instead of Polona.pl."""
+        index = MetadataIndex(self._index_path())
+        query = self.o.query if isinstance(self.o.query, str) else " ".join(self.o.query)
+        self.ids = []
+        self.hits = ad()
+        try:
+            hits = index.search(
+                query,
+                sort=self.o.sort,
+                languages=self.o.search_languages,
+                advanced=self.o.advanced,
+            )
+        except sqlite3.OperationalError as e:
+            log.critical("Invalid search %s: %s" % (query, e))
+            hits = []
+        finally:
+            index.close()
+        for hit in hits:
+            self.ids.append(hit.id)
+            self.hits[hit.id] = hit
+
+    def build_index(self):
+        """Add the items saved in the query folders to the local index."""
+        index = MetadataIndex(self._index_path())
+        for root in self.o.query:
+            count = index.ingest(root)
+            log.info("Indexed %d new or changed items in file://%s" % (count, root))
+        index.close()
+        log.success("Index saved in file://%s" % index.path)
+
+    def verify(self):
+        """Check the downloads in the query folders, output the IDs to repair."""
+        count, broken = verify_library(self.o.query)
+        self.ids = list(broken)
+        self.hits = ad()
+        for id, (slug, problems) in broken.items():
+            for problem in problems:
+                log.warning("%s: %s" % (id, problem))
+            hit = ad()
+            hit.id = id
+            hit.url = f"https://polona.pl/item/{slug},{id}/"
+            hit.problems = problems
+            self.hits[id] = hit
+        log.info("Verified %d docs, %d need to be downloaded again" % (count, len(broken)))
+        self.save_search_results()
+
+    def retag(self):
+        """Rewrite the PDF metadata in the query folders from their sidecars."""
+        counts = retag_library(
+            self.o.query,
+            linearize=self.o.linearize,
+            object_streams=self.o.object_streams,
+            deterministic=self.o.deterministic,
+        )
+        log.info(
+            "Retagged %(updated)d PDFs, %(unchanged)d unchanged, %(failed)d failed"
+            % counts
+        )
+        if counts["no_sidecar"]:
+            log.warning(
+                "%d PDFs have no YAML sidecar and were not retagged,"
+                " download them again to retag them" % counts["no_sidecar"]
+            )
+
+    def pack(self):
+        """Build PDFs from the --images folders in the query folders."""
+        transcode = None
+        if self.transcoder:
+            transcode = self.transcoder.settings
+        counts = pack_library(
+            self.o.query,
+            processes=self.o.transcode_jobs or None,
+            skip=self.o.skip,
+            transcode=transcode,
+            linearize=self.o.linearize,
+            object_streams=self.o.object_streams,
+            deterministic=self.o.deterministic,
+        )
+        log.info("Packed %(packed)d folders, %(skipped)d skipped, %(failed)d failed" % counts)
+
+    def _meta_dir(self):
+        return os.path.join(os.path.abspath(self.o.download_dir), ".pypolona")
+
+    def sync_search(self):
+        query_url = self._search_url()
+        state_path = os.path.join(
+            self._meta_dir(), "sync-%s.json" % search_key(query_url)
+        )
+        self.sync_state = SyncState(state_path, query_url)
+        new_ids = self.sync_state.update(self.ids)
+        log.info(
+            "Sync: %d of %d hits are new since %s"
+            % (len(new_ids), len(self.ids), self.sync_state.previous_run or "never")
+        )
+        self.ids = new_ids
+        if self.hits is not None:
+            self.hits = ad((id, self.hits[id]) for id in new_ids)
+
+    def sync_commit(self):
+        if self.o.download:
+            self.sync_state.mark(self.done_ids)
+        else:
+            self.sync_state.mark(self.ids)
+        self.sync_state.save()
+        log.info("Sync state saved in file://%s" % self.sync_state.path)
 
     def save_search_results(self):
         if self.o.format == "yaml":
@@ -130,6 +476,8 @@ class Polona:
             output = "\n".join([hit.url for hit in self.hits.values()])
         else:
             output = " ".join(self.hits.keys())
+        if not self.o.output and not self.o.emit_results:
+            return
         if self.o.output:
             outfile = open(self.o.output, "w")
         else:
@@ -142,95 +490,128 @@ class Polona:
         if self.o.output:
             log.success("Search results saved in: file://%s" % (self.o.output))
 
+    def _to_stdout(self):
+        return self.o.get("download_dir") == "-"
+
+    def _make_dldir(self):
+        self.dldir = os.path.abspath(self.o.download_dir)
+        if not os.path.isdir(self.dldir):
+            try:
+                os.makedirs(self.dldir)
+            except:
+                log.critical("Cannot create dir file://%s" % (self.dldir))
+        if self.o.layout != "flat":
+            self.paths = PathIndex(os.path.join(self._meta_dir(), "paths.tsv"))
+        return os.path.isdir(self.dldir)
+
+    def _item_path(self, hit, ext=""):
+        """Return the output path of hit in the --layout, creating its folder."""
+        shard = shard_dir(hit, self.o.layout)
+        if shard:
+            os.makedirs(os.path.join(self.dldir, shard), exist_ok=True)
+        return os.path.join(self.dldir, shard, hit.subdir + ext)
+
+    def _exists(self, path):
+        """Check for a saved item, in the path index of a sharded --layout."""
+        if self.paths is not None:
+            return os.path.relpath(path, self.dldir) in self.paths
+        return os.path.exists(path)
+
+    def _saved(self, hit, path):
+        if self.paths is not None:
+            self.paths.add(hit.id, os.path.relpath(path, self.dldir))
+
     def can_download(self):
         can_dl = False
         if len(self.ids) and self.o.download:
-            self.dldir = os.path.abspath(self.o.download_dir)
-            if not os.path.isdir(self.dldir):
-                try:
-                    os.makedirs(self.dldir)
-                except:
-                    log.critical("Cannot create dir file://%s" % (self.dldir))
-            if os.path.isdir(self.dldir):
-                can_dl = True
+            can_dl = self._make_dldir()
         return can_dl
 
-    def _process_hit(self, hit):
-        hit.subdir = []
-        year = hit.date
-        if year:
-            hit.year = dateutil.parser.parse(year).year
-            hit.subdir.append("%s-" % hit.year)
-        hit.subdir.append(hit.slug[:64])
-        hit.subdir.append("-%s" % hit.id)
-        hit.subdir = "-".join(hit.subdir)
-        hit.url = f"https://polona.pl/item/{hit.slug},{hit.id}/"
-        return hit
-
-    def _process_textpdf(self, hit):
-        return hit
-
-    def _process_dc(self, hit):
-        r = requests.get(hit.dc_url, stream=True)
-        if ".xml" in mimetypes.guess_all_extensions(
-            r.headers.get("content-type", "").split(";")[0]
-        ):
-            dc_root = lxml2json.convert(
-                etree.XML(r.content)[0],
-                ordered=True,
-                alwaysList=[
-                    ".//language",
-                    ".//country",
-                    ".//contributor",
-                    ".//creator",
-                    ".//subject",
-                    ".//tags",
-                ],
-            )
-            dc = dc_root.get(
-                "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description", {}
-            )
-            if len(dc.keys()):
-                hit.dc = dc
-        return hit
-
-    def _process_resources(self, hit):
-        for resource in hit.resources:
-            if ".pdf" in mimetypes.guess_all_extensions(resource.get("mime", "")):
-                hit.textpdf_url = resource.get("url", None)
-            if ".xml" in mimetypes.guess_all_extensions(resource.get("mime", "")):
-                hit.dc_url = resource.get("url", None)
-                if hit.dc_url:
-                    hit = self._process_dc(hit)
-        return hit
-
+    @timed
     def download_id(self, id, progress=""):
         success = False
-        url = "https://polona.pl/api/entities/" + id
-        log.debug(url)
-        r = requests.get(url)
-        hit = None
-        try:
-            hit = ad(r.json())
-        except:
-            h = html2text.HTML2Text()
-            log.critical(h.handle(r.text))
+        if self.limiter is not None:
+            self.limiter.start_doc()
+        hit = self.items.get(id) or self.client.get_item(id)
         if hit:
-            if hit.id:
-                hit = self._process_hit(hit)
-                hit.textpdf_url = None
-                hit.dc_url = None
-                if hit.resources:
-                    hit = self._process_resources(hit)
-
-            if hit.scans:
-                if len(hit.scans):
-                    success = self.save_downloaded(hit, progress)
+            # The cached item is shared with other runs, this one changes it
+            hit = ad(hit)
+        if hit and hit.get("scans"):
+            if self.o.format_out in ARCHIVE_FORMATS:
+                success = self.save_archived(hit, progress)
+            else:
+                success = self.save_downloaded(hit, progress)
         return success
 
+    def _select_pages(self, hit):
+        page_ranges = parse_page_ranges(self.o.pages) if self.o.pages else None
+        indices = select_pages(
+            len(hit.scans), page_ranges, self.o.every, self.o.max_pages
+        )
+        hit.selected_pages = [idx + 1 for idx in indices]
+        return indices
+
+    def save_archived(self, hit, progress):
+        """Stream the pages of hit into a --format-out archive.
+
+        The archive holds the files of the --images layout. With
+        `--download-dir -`, all docs go into one tar stream on stdout.
+        """
+        indices = self._select_pages(hit)
+        scans = [hit.scans[idx] for idx in indices]
+        total = len(scans)
+        log.info(
+            "%s: Downloading %03d/%03d pages in %s..."
+            % (progress, total, len(hit.scans), hit.subdir[:40])
+        )
+        archive = self.archive
+        if archive is None:
+            out_path = self._item_path(hit, "." + self.o.format_out)
+            if self._exists(out_path):
+                if self.o.skip:
+                    log.info(f"Skipping archive {out_path}")
+                    return True
+                log.warn(f"Overwriting archive {out_path}")
+            self.check_space(hit, scans)
+            archive = open_archive(self.o.format_out, out_path)
+        self.meter.start_doc(total)
+        archive.add(
+            "%s/%s.yaml" % (hit.subdir, hit.id),
+            oyaml.yaml_dump(hit).encode("utf-8"),
+            compress=True,
+        )
+        for num, (idx, img) in enumerate(
+            self.client.iter_pages(
+                hit, indices, self.o.resolution, self.o.page_retries, self.limiter
+            )
+        ):
+            log.debug("%s [page %03d/%03d]: downloading" % (progress, num + 1, total))
+            if img:
+                self.meter.update(pages=1, bytes=len(img))
+                archive.add("%s/%s-%04d.jpg" % (hit.subdir, hit.id, idx + 1), img)
+            # An unfinished archive stays a .part file and is made again
+            self.check_cancelled()
+        if hit.textpdf_url and not self.o.textpdf_skip:
+            pdf = self.client.download_textpdf(hit.textpdf_url, self.limiter)
+            if pdf:
+                pdf = self.client.add_pdf_meta(
+                    pdf,
+                    hit,
+                    self.o.linearize,
+                    self.o.object_streams,
+                    self.o.deterministic,
+                )
+                archive.add("%s/%s_text.pdf" % (hit.subdir, hit.id), pdf, compress=True)
+        if archive is not self.archive:
+            archive.close()
+            self._saved(hit, archive.path)
+            log.info("Saved archive to file://%s" % archive.path)
+        return True
+
+    @timed
     def save_downloaded(self, hit, progress):
         success = True
-        out_path = os.path.join(self.dldir, hit.subdir)
+        out_path = self._item_path(hit)
         textpdf_path = None
         if self.o.images:
             desttext = "folder"
@@ -246,207 +627,482 @@ class Polona:
 
         overwrite = True
 
-        if self.o.max_pages > 0:
-            total = len(hit.scans[: self.o.max_pages])
-        else:
-            total = len(hit.scans)
+        indices = self._select_pages(hit)
+        scans = [hit.scans[idx] for idx in indices]
+        total = len(scans)
         log.info(
             "%s: Downloading %03d/%03d pages in %s..."
             % (progress, total, len(hit.scans), hit.subdir[:40])
         )
-        if os.path.exists(out_path):
+        checkpoint = self._checkpoint_dir(hit)
+        resume = os.path.isdir(checkpoint)
+        if self._exists(out_path) and not resume:
             if self.o.skip:
                 overwrite = False
                 log.info(f"Skipping {desttext} {out_path}")
             else:
                 log.warn(f"Overwriting {desttext} {out_path}")
-        else:
-            if self.o.images:
-                os.makedirs(out_path)
-        if self.o.images:
-            with open(yaml_path, "w") as yamlfile:
-                print(yaml_path)
-                yamlfile.write(oyaml.yaml_dump(hit))
         if overwrite:
-            memimages = []
-            jpeg_mask = ""
-            for idx, scan in enumerate(hit.scans[:total]):
-                progressp = "[page %03d/%03d]" % (idx + 1, total)
-                if self.o.images:
-                    jpeg_mask = "%s-%04d.jpg" % (hit.id, idx + 1)
-                log.info(f"{progress} {progressp}: downloading")
-                for res in scan["resources"]:
-                    if res["mime"] == "image/jpeg":
-                        url = res["url"]
-                        img = self.download_scan(url)
-                        if img:
-                            if self.o.images:
-                                jpeg_path = os.path.join(out_path, jpeg_mask)
-                                with open(jpeg_path, "wb") as jpeg_file:
-                                    jpeg_file.write(img)
-                            else:
-                                memimages.append(img)
+            self.check_space(hit, scans, textpdf_path)
+            self.meter.start_doc(total)
+        if self.o.images and not os.path.exists(out_path):
+            os.makedirs(out_path)
+        if overwrite:
+            # A skipped doc keeps the sidecar that matches its saved pages
+            if self.o.images and self.o.emit_results:
+                print(yaml_path)
+            write_sidecar(yaml_path, hit)
+            # Pages saved by an interrupted run are not downloaded again
+            page_dir = out_path if self.o.images else checkpoint
+            saved = self._resumed_pages(hit, indices, page_dir) if resume else {}
+            if saved:
+                log.info("%s: %d pages already downloaded" % (progress, len(saved)))
+                self.meter.update(pages=len(saved))
+            todo = [idx for idx in indices if idx not in saved]
+            images = {}
+            pages = self.client.iter_pages(
+                hit, todo, self.o.resolution, self.o.page_retries, self.limiter
+            )
+            try:
+                for num, (idx, img) in enumerate(pages):
+                    progressp = "[page %03d/%03d]" % (num + 1, len(todo))
+                    log.debug(f"{progress} {progressp}: downloading")
+                    if img:
+                        self.meter.update(pages=1, bytes=len(img))
+                        if self.o.images:
+                            # Files keep the original scan numbers
+                            jpeg_path = os.path.join(
+                                out_path, "%s-%04d.jpg" % (hit.id, idx + 1)
+                            )
+                            write_file(jpeg_path, img, self.o.preallocate)
                         else:
-                            log.error("Cannot download %s" % (url))
+                            images[idx] = img
+                    self.check_cancelled()
+            except Cancelled:
+                self.save_checkpoint(hit, images)
+                raise
+            if not self.o.images:
+                for idx, path in saved.items():
+                    with open(path, "rb") as jpeg:
+                        images[idx] = jpeg.read()
+            memimages = [images[idx] for idx in indices if idx in images]
             if not self.o.images and len(memimages):
+                if self.transcoder:
+                    memimages = self.transcode(memimages)
                 log.info("Saving %s" % out_path)
-                success = self.pdf_save(out_path, memimages)
-                if success:
-                    success = self.pdf_add_meta(out_path, hit)
-                    if success:
-                        log.info("Saved high-res image PDF to file://%s" % (out_path))
+                pdf = self.client.build_pdf(
+                    hit,
+                    memimages,
+                    self.o.linearize,
+                    self.o.object_streams,
+                    self.o.deterministic,
+                )
+                write_file(out_path, pdf, self.o.preallocate)
+                self._checksum(out_path)
+                log.info("Saved high-res image PDF to file://%s" % (out_path))
             if textpdf_path and not self.o.textpdf_skip:
                 success = self.download_save_textpdf(hit.textpdf_url, textpdf_path)
                 if success:
                     success = self.pdf_add_meta(textpdf_path, hit)
                     if success:
+                        self._checksum(textpdf_path)
                         log.info(
                             "Saved searchable text PDF to file://%s" % (textpdf_path)
                         )
+            if success and os.path.exists(out_path):
+                self._saved(hit, out_path)
+            if resume:
+                shutil.rmtree(checkpoint, ignore_errors=True)
+        if self.merger is not None and not self.o.images and os.path.exists(out_path):
+            self.merger.add(hit, out_path)
         return success
 
+    def _checksum(self, path):
+        """Record the content hash of a --deterministic output next to it."""
+        if self.o.deterministic:
+            write_checksum(path)
+
+    def _checkpoint_dir(self, hit):
+        return os.path.join(self._meta_dir(), "partial", hit.id)
+
+    def _resumed_pages(self, hit, indices, page_dir):
+        """Return {index: path} of the complete pages of hit in page_dir."""
+        saved = {}
+        for idx in indices:
+            path = os.path.join(page_dir, "%s-%04d.jpg" % (hit.id, idx + 1))
+            if os.path.exists(path) and jpeg_complete(path):
+                saved[idx] = path
+        return saved
+
+    def save_checkpoint(self, hit, images):
+        """Keep the downloaded pages of hit for the next run.
+
+        `images` are the {index: JPEG} of a PDF that was not made yet;
+        --images pages are already in their folder.
+        """
+        checkpoint = self._checkpoint_dir(hit)
+        os.makedirs(checkpoint, exist_ok=True)
+        for idx, img in images.items():
+            write_file(os.path.join(checkpoint, "%s-%04d.jpg" % (hit.id, idx + 1)), img)
+        log.info("Checkpoint of %s saved in file://%s" % (hit.id, checkpoint))
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise Cancelled()
+
+    @contextlib.contextmanager
+    def cancel_on_signals(self):
+        """Turn Ctrl-C and SIGTERM into a cancellation of the run.
+
+        The first signal lets the pages in flight finish and checkpoints
+        the docs being downloaded; a second Ctrl-C quits right away.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        def cancel(signum, frame):
+            if self.cancelled.is_set():
+                raise KeyboardInterrupt()
+            log.warning("Stopping after the pages being downloaded...")
+            self.cancelled.set()
+
+        signums = [signal.SIGINT, signal.SIGTERM]
+        if hasattr(signal, "SIGBREAK"):
+            signums.append(signal.SIGBREAK)
+        previous = {signum: signal.signal(signum, cancel) for signum in signums}
+        try:
+            yield
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    @timed
+    def transcode(self, memimages):
+        try:
+            images, size_in, size_out = self.transcoder.transcode(memimages)
+        except Exception as e:
+            log.error("Cannot transcode, keeping the original scans: %s" % e)
+            return memimages
+        log.info(
+            "Transcoded %d pages: %s -> %s (%+.0f%%)"
+            % (
+                len(images),
+                format_size(size_in),
+                format_size(size_out),
+                100.0 * (size_out - size_in) / max(size_in, 1),
+            )
+        )
+        return images
+
+    def _scan_url(self, scan):
+        return self.client.scan_url(scan, self.o.resolution)
+
+    def _content_length(self, url):
+        return self.client.content_length(url)
+
+    def estimate_size(self, hit, scans, textpdf_path=None):
+        """Estimate the disk space needed to save the scans of hit."""
+        urls = [self._scan_url(scan) for scan in scans]
+        if len(urls) > 3:
+            urls = [urls[0], urls[len(urls) // 2], urls[-1]]
+        sizes = [
+            (url and self._content_length(url)) or DEFAULT_PAGE_SIZE for url in urls
+        ]
+        size = len(scans) * sum(sizes) / max(len(sizes), 1)
+        if textpdf_path and not self.o.textpdf_skip:
+            size += self._content_length(hit.textpdf_url) or 0
+        return int(size)
+
+    def check_space(self, hit, scans, textpdf_path=None):
+        """Raise NotEnoughSpace if the scans of hit will not fit on the disk."""
+        available = free_space(self.dldir) - self.o.min_free * 1024 * 1024
+        if available > 2 * len(scans) * MAX_PAGE_SIZE:
+            return
+        needed = self.estimate_size(hit, scans, textpdf_path)
+        log.debug(
+            "%s needs about %s, %s available"
+            % (hit.id, format_size(needed), format_size(available))
+        )
+        if needed > available:
+            raise NotEnoughSpace(self.dldir, needed, max(available, 0))
+
+    def wait_for_space(self, needed):
+        """Pause for up to --space-wait seconds until `needed` bytes are free."""
+        deadline = time.time() + self.o.space_wait
+        while time.time() < deadline:
+            log.warning(
+                "Waiting for %s of free space in file://%s"
+                % (format_size(needed), self.dldir)
+            )
+            time.sleep(min(30, self.o.space_wait))
+            available = free_space(self.dldir) - self.o.min_free * 1024 * 1024
+            if available >= needed:
+                return True
+        return False
+
+    @timed
     def pdf_add_meta(self, pdf_path, hit):
-        success = False
         pdf = pikepdf.open(pdf_path, allow_overwriting_input=True)
-        with pdf.open_metadata() as meta:
-            meta["xmp:CreatorTool"] = "PyPolona %s" % (version)
-            id = hit.get("id", None)
-            ids = []
-            if id:
-                ids.append(id)
-                meta["dc:identifier"] = hit["id"]
-            dc = hit.get("dc", {})
-            if hit.get("isbn", None):
-                meta["prism2:isbn"] = hit["isbn"]
-                ids.append(hit["isbn"])
-            if hit.get("issn", None):
-                meta["prism2:issn"] = hit["isbn"]
-                ids.append(hit["issn"])
-            if hit.get("academica_id", None):
-                ids.append(hit["academica_id"])
-            if hit.get("oclc_no", None):
-                ids.append(hit["oclc_no"])
-            ids += hit.get("call_no", [])
-            meta["xmp:Identifier"] = {"%s" % i for i in ids}
-            if hit.get("title", None):
-                meta["dc:title"] = hit["title"]
-            if hit.get("date", None):
-                meta["dc:date"] = [hit["date"]]
-            if hit.get("date_descriptive", None):
-                meta["prism2:timePeriod"] = [hit["date_descriptive"]]
-            if hit.get("url", None):
-                meta["dc:source"] = hit["url"]
-                meta["prism2:url"] = hit["url"]
-            author = hit.get("creator_name", None)
-            if not author:
-                author = hit.get("creator", None)
-            contributors = hit.get("contributor", None)
-            if type(contributors) is list:
-                meta["dc:contributor"] = set(contributors)
-                if not author:
-                    author = contributors[0]
-            if not author:
-                author = ""
-            meta["dc:creator"] = [author.replace(",", " ").replace("  ", " ")]
-            meta["dc:source"] = hit["url"]
-            dc_langs = dc.get("language", None)
-            if type(dc_langs) is list:
-                meta["dc:language"] = {s["text"].strip() for s in dc_langs}
-            rights = hit.get("rights", None)
-            if type(rights) is list:
-                rights = ";".join(rights)
-                meta["dc:rights"] = rights
-                meta["xmpRights:WebStatement"] = rights
-            categories = hit.get("categories", None)
-            if len(categories):
-                meta["dc:type"] = set(categories)
-                meta["prism2:contentType"] = "; ".join(categories)
-            keywords = []
-            if type(hit.get("subject", None)) is list:
-                keywords += hit["subject"]
-            if type(hit.get("keywords", None)) is list:
-                keywords += hit["keywords"]
-            if type(hit.get("categories", None)) is list:
-                keywords += hit["categories"]
-            if type(hit.get("metatypes", None)) is list:
-                keywords += hit["metatypes"]
-            if type(hit.get("projects", None)) is list:
-                keywords += hit["projects"]
-            dc_tags = dc.get("tags", None)
-            if dc_tags:
-                keywords += [s["text"] for s in dc_tags]
-            keywords = sorted(set(keywords))
-            if len(keywords):
-                meta["dc:subject"] = set(keywords)
-                meta["pdf:Keywords"] = "; ".join(keywords)
-            publisher = []
-            if hit.get("publisher", None):
-                publisher.append(hit["publisher"])
-            if hit.get("imprint", None):
-                publisher.append(hit["imprint"])
-            if len(publisher):
-                meta["dc:publisher"] = set(publisher)
-            if hit.get("publish_place", None) or hit.get("country", None):
-                meta["prism2:location"] = ", ".join(
-                    hit.get("publish_place", []) + hit.get("country", [])
-                )
-            description = []
-            if hit.get("series", None):
-                meta["prism2:seriesTitle"] = hit["series"]
-                description.append(hit["series"])
-            dc_freq = dc.get("frequency", {}).get("text", None)
-            if dc_freq:
-                meta["prism2:publishingFrequency"] = dc_freq
-                description.append(dc_freq)
-            if hit.get("press_title", None):
-                meta["prism2:publicationName"] = hit["press_title"]
-                description.append(hit["press_title"])
-            if type(hit.get("notes", None)) is list:
-                description += hit["notes"]
-            if type(hit.get("physical_description", None)) is list:
-                description += hit["physical_description"]
-            if type(hit.get("sources", None)) is list:
-                description += hit["sources"]
-            if type(hit.get("projects", None)) is list:
-                description += hit["projects"]
-            if len(description):
-                description_text = "; ".join(str(description))
-                meta["dc:description"] = description_text
-        pdf.save(pdf_path)
-        return success
+        write_meta(pdf, hit, self.o.deterministic)
+        pdf.save(
+            pdf_path,
+            **save_options(
+                self.o.linearize, self.o.object_streams, self.o.deterministic
+            ),
+        )
+        return True
 
-    def pdf_save(self, pdf_path, memimages):
-        if len(memimages):
-            with open(pdf_path, "wb") as pdffile:
-                pdffile.write(img2pdf.convert(memimages))
+    @timed
+    def download_save_textpdf(self, url, pdf_path):
+        pdf = self.client.download_textpdf(url, self.limiter)
+        if pdf:
+            write_file(pdf_path, pdf, self.o.preallocate)
             return True
         else:
             return False
 
-    def download_save_textpdf(self, url, pdf_path):
-        r = requests.get(url, stream=True)
-        if ".pdf" in mimetypes.guess_all_extensions(r.headers.get("content-type", "")):
-            with open(pdf_path, "wb") as pdf_file:
-                pdf_file.write(r.content)
-            return True
+    def download_ids(self):
+        total = len(self.ids)
+        pending = list(enumerate(self.ids))
+        self.meter.add_docs(total)
+        if self.o.sjf:
+            pending = self.shortest_first(pending)
+        # --sjf has fetched all items already
+        prefetcher = Prefetcher(self.client, 0 if self.o.sjf else self.o.lookahead)
+        try:
+            while pending:
+                deferred = self._download_pending(pending, total, prefetcher)
+                if not deferred:
+                    break
+                # Retry the smallest docs first, and pause if nothing fitted
+                deferred.sort()
+                if len(deferred) == len(pending) and not self.wait_for_space(
+                    deferred[0][0]
+                ):
+                    log.error(
+                        "Not enough space to download: %s"
+                        % " ".join(id for needed, idx, id in deferred)
+                    )
+                    break
+                pending = [(idx, id) for needed, idx, id in deferred]
+        finally:
+            prefetcher.close()
+
+    def _download_pending(self, pending, total, prefetcher):
+        """Download the (idx, id) docs in pending, --jobs at a time.
+
+        Returns (needed, idx, id) for the docs postponed for lack of space.
+        """
+
+        def download(pos):
+            self.check_cancelled()
+            idx, id = pending[pos]
+            # The next --jobs - 1 docs are already being downloaded
+            prefetcher.fetch(id for idx, id in pending[pos + self.o.jobs :])
+            progress = "[doc %03d/%03d]" % (idx + 1, total)
+            try:
+                if self.download_id(id, progress):
+                    self.done_ids.append(id)
+                    self.meter.update(docs=1)
+                    log.info(f"{progress}: {id} processed")
+            except NotEnoughSpace as e:
+                log.warning(f"{progress}: {e}, will try {id} later")
+                return (e.needed, idx, id)
+            return None
+
+        if self.o.jobs > 1:
+            with ThreadPoolExecutor(max_workers=self.o.jobs) as pool:
+                results = list(pool.map(download, range(len(pending))))
         else:
-            return False
+            results = [download(pos) for pos in range(len(pending))]
+        return [result for result in results if result]
 
-    def download_scan(self, url):
-        r = requests.get(url, stream=True)
-        if ".jpg" in mimetypes.guess_all_extensions(r.headers.get("content-type", "")):
-            return r.content
+    def shortest_first(self, pending):
+        """Order the (idx, id) docs in pending by their number of pages."""
+        page_ranges = parse_page_ranges(self.o.pages) if self.o.pages else None
+
+        def page_count(item):
+            try:
+                hit = self.client.get_item(item[1])
+            except Exception:
+                hit = None
+            if hit:
+                self.items[item[1]] = hit
+            if not hit or not hit.get("scans"):
+                return 0
+            return len(
+                select_pages(len(hit.scans), page_ranges, self.o.every, self.o.max_pages)
+            )
+
+        with ThreadPoolExecutor(max_workers=max(self.o.lookahead, self.o.jobs, 1)) as pool:
+            counts = list(pool.map(page_count, pending))
+        order = sorted(range(len(pending)), key=lambda n: counts[n])
+        return [pending[n] for n in order]
+
+    def download_queue(self):
+        queue = open_queue(self.o.queue, lease_time=self.o.lease_time)
+        if len(self.ids):
+            queue.put(self.ids)
+        if self.o.workers > 1:
+            ctx = multiprocessing.get_context("spawn")
+            # Workers stay quiet, the coordinator reports the queue progress,
+            # and share the --limit-rate evenly
+            worker_opts = dict(
+                self.o,
+                progress="none",
+                status_file=None,
+                limit_rate=self.o.limit_rate / self.o.workers,
+            )
+            workers = [
+                ctx.Process(target=queue_worker, args=(worker_opts, "w%02d" % (n + 1)))
+                for n in range(self.o.workers)
+            ]
+            for worker in workers:
+                worker.start()
+            counts = queue.counts()
+            self.meter.add_docs(sum(counts.values()))
+            done = counts.get("done", 0)
+            stopping = False
+            while any(worker.is_alive() for worker in workers):
+                if self.cancelled.is_set() and not stopping:
+                    # SIGTERM: workers checkpoint and release their leases
+                    for worker in workers:
+                        if worker.is_alive():
+                            worker.terminate()
+                    stopping = True
+                workers[0].join(timeout=self.meter.interval)
+                now_done = queue.counts().get("done", 0)
+                self.meter.update(docs=now_done - done)
+                done = now_done
+            for worker in workers:
+                worker.join()
         else:
-            return None
+            self.work_queue()
+        self.done_ids = queue.done(self.ids)
+        log.info(
+            "Queue file://%s: %s"
+            % (
+                self.o.queue,
+                ", ".join("%s %d" % (k, v) for k, v in sorted(queue.counts().items())),
+            )
+        )
+        queue.close()
+        self.check_cancelled()
 
-    def download_ids(self):
-        all = self.ids
-        total = len(all)
-        for idx, id in enumerate(all):
-            progress = "[doc %03d/%03d]" % (idx + 1, total)
-            if self.download_id(id, progress):
-                log.info(f"{progress}: {id} processed")
+    def work_queue(self, name="w01"):
+        worker = "%s:%d:%s" % (socket.gethostname(), os.getpid(), name)
+        queue = open_queue(self.o.queue, lease_time=self.o.lease_time)
+        try:
+            while True:
+                id = queue.lease(worker)
+                if id is None:
+                    break
+                self.meter.add_docs(1)
+                progress = "[%s] [doc %s]" % (name, id)
+                keeper = LeaseKeeper(self.o.queue, id, worker, self.o.lease_time)
+                keeper.start()
+                try:
+                    self.check_cancelled()
+                    success = self.download_id(id, progress)
+                except Cancelled:
+                    queue.release(id, worker)
+                    raise
+                except Exception as e:
+                    log.error(f"{progress}: {e}")
+                    success = False
+                finally:
+                    keeper.stop()
+                if success:
+                    queue.complete(id, worker)
+                    self.meter.update(docs=1)
+                    log.info(f"{progress}: {id} processed")
+                else:
+                    queue.fail(id, worker, "download failed")
+        finally:
+            queue.close()
 
     def download(self):
-        if self.can_download():
+        if self.o.merge_into:
+            if self._to_stdout() or self.o.queue:
+                log.critical("--merge-into cannot be used with --queue or stdout")
+                return
+            if self.o.images or self.o.format_out != "pdf":
+                log.critical("--merge-into needs PDF output")
+                return
+        if self._to_stdout():
+            # Docs downloaded in parallel would interleave their tar members
+            if self.o.format_out != "tar" or self.o.queue or self.o.jobs > 1:
+                log.critical(
+                    "Only --format-out tar without --queue or --jobs can go to stdout"
+                )
+                return
+            if len(self.ids):
+                self.archive = open_archive("tar", "-")
+                self.download_ids()
+                self.archive.close()
+        elif self.o.queue:
+            if self._make_dldir():
+                self.download_queue()
+        elif self.can_download():
+            if self.o.merge_into:
+                self.merger = PdfMerger(
+                    self.o.merge_into,
+                    self.ids,
+                    self.o.linearize,
+                    self.o.object_streams,
+                    self.o.deterministic,
+                )
             self.download_ids()
+            if self.merger is not None:
+                count = self.merger.close()
+                if count:
+                    self._checksum(self.merger.path)
+                log.info("Merged %d docs into file://%s" % (count, self.merger.path))
+
+
+class Prefetcher:
+    """Fetch the metadata of the next `lookahead` docs in the background.
+
+    The items land in the item cache of the client, and a doc whose item
+    is still being fetched joins that request, so scans never wait for a
+    metadata round-trip that could have started earlier.
+    """
+
+    def __init__(self, client, lookahead=4):
+        self.client = client
+        self.lookahead = lookahead
+        self.pool = ThreadPoolExecutor(max_workers=lookahead) if lookahead > 0 else None
+        self.started = set()
+
+    def fetch(self, next_ids):
+        if self.pool is None:
+            return
+        for n, id in enumerate(next_ids):
+            if n >= self.lookahead:
+                break
+            if id not in self.started:
+                self.started.add(id)
+                self.pool.submit(self._get_item, id)
+
+    def _get_item(self, id):
+        try:
+            self.client.get_item(id)
+        except Exception as e:
+            # download_id() fetches it again and reports the error
+            log.debug("Prefetching %s failed: %s" % (id, e))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+
+def queue_worker(opts, name):
+    """Entry point of a `--workers` process."""
+    polona = Polona(**opts)
+    if polona._make_dldir():
+        try:
+            with polona.cancel_on_signals():
+                polona.work_queue(name)
+        except Cancelled:
+            pass
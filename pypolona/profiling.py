@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+pypolona.profiling
+------------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Profiling for `--profile`: cProfile (cpu), tracemalloc (mem) and call
+timers on the hot functions (time). The timers are off by default and
+cost one flag check per call then; `enable_timers()` turns them on.
+"""
+
+import functools
+import io
+import logging
+import pstats
+import threading
+import time
+
+log = logging.getLogger("pypolona")
+
+_timers_enabled = False
+_timers_lock = threading.Lock()
+# Function name -> [calls, total seconds, max seconds]
+TIMERS = {}
+
+
+def enable_timers(enabled=True):
+    global _timers_enabled
+    _timers_enabled = enabled
+
+
+def reset_timers():
+    with _timers_lock:
+        TIMERS.clear()
+
+
+def timed(func):
+    """Record the calls and run time of func while the timers are on."""
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _timers_enabled:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            with _timers_lock:
+                timer = TIMERS.setdefault(name, [0, 0.0, 0.0])
+                timer[0] += 1
+                timer[1] += elapsed
+                timer[2] = max(timer[2], elapsed)
+
+    return wrapper
+
+
+def format_timers():
+    lines = ["%-36s %8s %10s %10s %10s" % ("function", "calls", "total s", "mean s", "max s")]
+    with _timers_lock:
+        timers = sorted(TIMERS.items(), key=lambda item: -item[1][1])
+    for name, (calls, total, longest) in timers:
+        lines.append(
+            "%-36s %8d %10.3f %10.4f %10.4f"
+            % (name, calls, total, total / max(calls, 1), longest)
+        )
+    return "\n".join(lines)
+
+
+def profile_call(kind, func, out_path, limit=30):
+    """Run func under the --profile kind (cpu, mem or time), save the report
+    to out_path and log a summary. Returns the result of func.
+    """
+    enable_timers()
+    try:
+        if kind == "cpu":
+            import cProfile
+
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(func)
+            finally:
+                profiler.dump_stats(out_path)
+                summary = io.StringIO()
+                stats = pstats.Stats(profiler, stream=summary)
+                stats.sort_stats("cumulative").print_stats(limit)
+                log.info(summary.getvalue())
+        elif kind == "mem":
+            import tracemalloc
+
+            tracemalloc.start(25)
+            try:
+                return func()
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                stats = snapshot.statistics("lineno")
+                lines = ["Current %d bytes, peak %d bytes" % (current, peak)]
+                lines += [str(stat) for stat in stats[:limit]]
+                with open(out_path, "w") as report:
+                    report.write("\n".join(lines) + "\n")
+                log.info("\n".join(lines[: limit // 3 + 1]))
+        else:
+            try:
+                return func()
+            finally:
+                with open(out_path, "w") as report:
+                    report.write(format_timers() + "\n")
+    finally:
+        log.info(format_timers())
+        log.info("Profile saved in file://%s" % out_path)
+        enable_timers(False)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+pypolona.progress
+-----------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Progress counters with throughput and ETA, reported to pluggable sinks
+at a throttled rate.
+"""
+
+import abc
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    from .storage import format_size
+except ImportError:
+    from pypolona.storage import format_size
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%02d:%02d" % (minutes, seconds)
+
+
+class Progress:
+    """Thread-safe docs/pages/bytes counters.
+
+    `update()` is cheap; the sinks are only called when at least
+    `interval` seconds have passed since the last report.
+    """
+
+    def __init__(self, sinks=(), interval=1.0):
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_emit = float("-inf")
+        self.docs_total = 0
+        self.docs_started = 0
+        self.docs_done = 0
+        self.pages_total = 0
+        self.pages_done = 0
+        self.bytes = 0
+
+    def add_docs(self, count):
+        with self.lock:
+            self.docs_total += count
+
+    def start_doc(self, pages):
+        with self.lock:
+            self.docs_started += 1
+            self.pages_total += pages
+
+    def update(self, docs=0, pages=0, bytes=0):
+        with self.lock:
+            self.docs_done += docs
+            self.pages_done += pages
+            self.bytes += bytes
+            now = time.monotonic()
+            if now - self.last_emit < self.interval:
+                return
+            self.last_emit = now
+        self.emit()
+
+    def fraction(self):
+        """Estimated done fraction of the whole run."""
+        if not self.pages_total:
+            return min(self.docs_done / max(self.docs_total, 1), 1.0)
+        # Docs that have not started yet are assumed to be of average length
+        pages_per_doc = self.pages_total / self.docs_started
+        unstarted = max(self.docs_total - self.docs_started, 0)
+        pages_total = self.pages_total + unstarted * pages_per_doc
+        return min(self.pages_done / pages_total, 1.0)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            fraction = self.fraction()
+            eta = None
+            if fraction > 0:
+                eta = elapsed * (1 - fraction) / fraction
+            return {
+                "docs_done": self.docs_done,
+                "docs_total": self.docs_total,
+                "pages_done": self.pages_done,
+                "pages_total": self.pages_total,
+                "bytes": self.bytes,
+                "elapsed": round(elapsed, 1),
+                "pages_per_second": round(self.pages_done / max(elapsed, 1e-6), 2),
+                "bytes_per_second": round(self.bytes / max(elapsed, 1e-6)),
+                "fraction": round(fraction, 4),
+                "eta": round(eta, 1) if eta is not None else None,
+            }
+
+    def emit(self):
+        status = self.snapshot()
+        for sink in self.sinks:
+            sink.write(status)
+
+    def close(self):
+        self.emit()
+        for sink in self.sinks:
+            sink.close()
+
+
+class Sink(abc.ABC):
+    @abc.abstractmethod
+    def write(self, status):
+        """Report the status dict of Progress.snapshot()."""
+
+    def close(self):
+        pass
+
+
+class TerminalSink(Sink):
+    """Single-line progress bar, redrawn in place."""
+
+    def __init__(self, stream=None, width=30):
+        self.stream = stream or sys.stderr
+        self.width = width
+
+    def write(self, status):
+        filled = int(status["fraction"] * self.width)
+        self.stream.write(
+            "\r[%s%s] %d/%d docs, %d pages, %s, %s/s, ETA %s "
+            % (
+                "#" * filled,
+                "." * (self.width - filled),
+                status["docs_done"],
+                status["docs_total"],
+                status["pages_done"],
+                format_size(status["bytes"]),
+                format_size(status["bytes_per_second"]),
+                format_duration(status["eta"]),
+            )
+        )
+        self.stream.flush()
+
+    def close(self):
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+class GooeySink(Sink):
+    """Lines matched by the `progress_regex` of the Gooey GUI."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def write(self, status):
+        self.stream.write("progress: %d%%\n" % int(status["fraction"] * 100))
+        self.stream.flush()
+
+
+class JsonSink(Sink):
+    """JSON status file, replaced atomically on every report."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, status):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as status_file:
+            json.dump(status, status_file)
+        os.replace(tmp_path, self.path)
+
+
+def make_progress(kind="auto", status_file=None, interval=1.0):
+    """Build a Progress for the --progress and --status-file options."""
+    if kind == "auto":
+        # Gooey sets GOOEY=1 for the program it runs from the GUI
+        if os.environ.get("GOOEY"):
+            kind = "gooey"
+        else:
+            kind = "bar" if sys.stderr.isatty() else "none"
+    sinks = []
+    if kind == "bar":
+        sinks.append(TerminalSink())
+    elif kind == "gooey":
+        sinks.append(GooeySink())
+    if status_file:
+        sinks.append(JsonSink(status_file))
+    return Progress(sinks, interval)
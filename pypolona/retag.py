@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+pypolona.retag
+--------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+`--retag`: rewrite the XMP metadata of existing PDFs from their YAML
+sidecars, offline and in parallel. PDFs whose stored metadata hash
+matches the sidecar and the current write_meta() are left alone, unless
+they are to be saved with new options.
+"""
+
+import logging
+import os.path
+from concurrent.futures import ProcessPoolExecutor
+
+import pikepdf
+
+try:
+    from .library import iter_library, read_sidecar
+except ImportError:
+    from pypolona.library import iter_library, read_sidecar
+try:
+    from .pdfmeta import meta_hash, read_meta_hash, save_options, write_meta
+except ImportError:
+    from pypolona.pdfmeta import meta_hash, read_meta_hash, save_options, write_meta
+try:
+    from .storage import write_checksum
+except ImportError:
+    from pypolona.storage import write_checksum
+
+log = logging.getLogger("pypolona")
+
+
+def retag_pdf(
+    path, hit, linearize=False, object_streams=False, deterministic=False, force=False
+):
+    """Rewrite the metadata of the PDF at path for hit.
+
+    A `<path>.sha256` content hash is updated as well, and made with
+    `deterministic`. The PDF is always rewritten if any of the save
+    options is set, as the metadata hash does not record them.
+    Returns "updated", "unchanged" or "failed".
+    """
+    force = force or linearize or object_streams or deterministic
+    try:
+        with pikepdf.open(path, allow_overwriting_input=True) as pdf:
+            if not force and read_meta_hash(pdf) == meta_hash(hit):
+                return "unchanged"
+            write_meta(pdf, hit, deterministic)
+            pdf.save(path, **save_options(linearize, object_streams, deterministic))
+        if deterministic or os.path.exists(path + ".sha256"):
+            write_checksum(path)
+    except Exception as e:
+        log.error("Cannot retag file://%s: %s" % (path, e))
+        return "failed"
+    return "updated"
+
+
+def item_pdfs(item):
+    """Return the image and text PDFs of a saved item that exist."""
+    if item.kind == "folder":
+        paths = [os.path.join(item.path, "%s_text.pdf" % item.id)]
+    else:
+        paths = [item.path, item.path[: -len(".pdf")] + "_text.pdf"]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def _retag_args(args):
+    item, settings = args
+    hit = read_sidecar(item.sidecar)
+    if not hit:
+        return ["failed"]
+    return [retag_pdf(path, hit, **settings) for path in item_pdfs(item)]
+
+
+def retag_library(roots, processes=None, **settings):
+    """Retag the PDFs of all items with sidecars under roots.
+
+    `settings` go to retag_pdf(). Returns the counts of the results,
+    with the PDFs that cannot be retagged for lack of a sidecar as
+    "no_sidecar".
+    """
+    items = [item for root in roots for item in iter_library(root)]
+    no_sidecar = [item for item in items if not item.sidecar]
+    items = [item for item in items if item.sidecar]
+    counts = {
+        "updated": 0,
+        "unchanged": 0,
+        "failed": 0,
+        "no_sidecar": len(no_sidecar),
+    }
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for results in pool.map(
+            _retag_args, [(item, settings) for item in items], chunksize=16
+        ):
+            for result in results:
+                counts[result] += 1
+    return counts
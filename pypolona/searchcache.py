@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+pypolona.searchcache
+--------------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Cache of search results on disk, keyed by the normalized search URL, so
+that repeating a search within `--search-ttl` minutes does not ask
+Polona.pl again.
+"""
+
+import json
+import logging
+import os
+import os.path
+import sys
+import time
+import urllib.parse
+
+from orderedattrdict import AttrDict as ad
+
+try:
+    from .storage import write_file
+except ImportError:
+    from pypolona.storage import write_file
+try:
+    from .sync import search_key
+except ImportError:
+    from pypolona.sync import search_key
+
+log = logging.getLogger("pypolona")
+
+
+def user_cache_dir():
+    """Return the per-user cache folder of PyPolona."""
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "pypolona")
+
+
+def normalize_search_url(url):
+    """Return url with its query parameters in a fixed order."""
+    parts = urllib.parse.urlsplit(url)
+    params = sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+    return urllib.parse.urlunsplit(
+        parts._replace(query=urllib.parse.urlencode(params))
+    )
+
+
+class SearchCache:
+    """Search hits stored as one JSON file per search in folder.
+
+    Entries older than `ttl` seconds are ignored and replaced by the next
+    put().
+    """
+
+    def __init__(self, folder, ttl):
+        self.folder = folder
+        self.ttl = ttl
+
+    def path(self, url):
+        return os.path.join(
+            self.folder, "search-%s.json" % search_key(normalize_search_url(url))
+        )
+
+    def get(self, url):
+        """Return the cached hits of the search at url, or None."""
+        path = self.path(url)
+        try:
+            with open(path, encoding="utf-8") as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        if entry.get("url") != normalize_search_url(url):
+            return None
+        if time.time() - entry.get("time", 0) > self.ttl:
+            return None
+        return [ad(hit) for hit in entry.get("hits", [])]
+
+    def put(self, url, hits):
+        """Store the hits of the search at url."""
+        entry = {"url": normalize_search_url(url), "time": time.time(), "hits": hits}
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            write_file(
+                self.path(url),
+                json.dumps(entry, ensure_ascii=False).encode("utf-8"),
+            )
+        except OSError as e:
+            log.warning("Cannot cache search results in file://%s: %s" % (self.folder, e))
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+pypolona.service
+----------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+`--serve`: a long-running local job API. Jobs take the same arguments as
+the ppolona CLI and run in one process with one shared PolonaClient, so
+its connection pool and caches stay warm between jobs.
+
+    POST /jobs          {"args": ["-S", "-D", "sienkiewicz"]} -> job
+    GET  /jobs          all jobs
+    GET  /jobs/<id>     one job, with its progress and result
+    GET  /metrics       job counts, throughput and cache statistics
+
+The address is `host:port` or `unix:/path/to/socket`.
+"""
+
+import itertools
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    from .client import PolonaClient
+except ImportError:
+    from pypolona.client import PolonaClient
+try:
+    from .polona import Polona
+except ImportError:
+    from pypolona.polona import Polona
+
+log = logging.getLogger("pypolona")
+
+# Options a job cannot change
+JOB_OPTS = {"serve": False, "progress": "none", "emit_results": False}
+
+
+class Job:
+    def __init__(self, id, args, opts):
+        self.id = id
+        self.args = args
+        self.opts = opts
+        self.state = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.polona = None
+        self.result = None
+        self.error = None
+
+    def status(self):
+        status = {
+            "id": self.id,
+            "args": self.args,
+            "state": self.state,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+            "result": self.result,
+        }
+        if self.polona is not None:
+            status["progress"] = self.polona.meter.snapshot()
+        return status
+
+
+class JobService:
+    """Queue of ppolona jobs run by `jobs` threads with one shared client."""
+
+    def __init__(self, parse_args, jobs=2, client=None, keep=1000):
+        self.parse_args = parse_args
+        self.client = client or PolonaClient(pool_size=max(10, jobs * 4))
+        self.pending = queue.Queue()
+        self.jobs = {}
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.started = time.time()
+        self.totals = {"docs": 0, "pages": 0, "bytes": 0}
+        self.runners = [
+            threading.Thread(target=self._run_jobs, name="job-%d" % (n + 1), daemon=True)
+            for n in range(max(jobs, 1))
+        ]
+        for runner in self.runners:
+            runner.start()
+
+    def submit(self, args):
+        """Queue a job for the CLI arguments args, return it.
+
+        Raises ValueError if the arguments are not valid.
+        """
+        if not isinstance(args, list) or not all(isinstance(a, str) for a in args):
+            raise ValueError("args must be a list of strings")
+        try:
+            opts = vars(self.parse_args(args))
+        except SystemExit:
+            raise ValueError("invalid arguments: %s" % " ".join(args))
+        # stdout, worker processes and the profilers belong to the daemon
+        if opts.get("download_dir") == "-":
+            raise ValueError("jobs cannot write to stdout (--download-dir -)")
+        if (opts.get("workers") or 0) > 1:
+            raise ValueError("jobs cannot start --workers processes")
+        if opts.get("profile", "none") != "none":
+            raise ValueError("jobs cannot use --profile")
+        opts.update(JOB_OPTS)
+        with self.lock:
+            job = Job(str(next(self.ids)), args, opts)
+            self.jobs[job.id] = job
+            self._forget_old_jobs()
+        self.pending.put(job)
+        return job
+
+    def _forget_old_jobs(self):
+        finished = [job for job in self.jobs.values() if job.finished]
+        for job in finished[: max(len(finished) - self.keep, 0)]:
+            del self.jobs[job.id]
+
+    def _run_jobs(self):
+        while True:
+            job = self.pending.get()
+            if job is None:
+                break
+            self.run_job(job)
+
+    def run_job(self, job):
+        job.state = "running"
+        job.started = time.time()
+        try:
+            job.polona = Polona(client=self.client, **job.opts)
+            job.polona.run()
+            job.result = {"ids": job.polona.ids, "done_ids": job.polona.done_ids}
+            if job.polona.hits:
+                job.result["hits"] = job.polona.hits
+            job.state = "done"
+        except Exception as e:
+            log.error("Job %s failed: %s" % (job.id, e))
+            job.error = str(e)
+            job.state = "failed"
+        finally:
+            job.finished = time.time()
+            if job.polona is not None:
+                snapshot = job.polona.meter.snapshot()
+                with self.lock:
+                    self.totals["docs"] += snapshot["docs_done"]
+                    self.totals["pages"] += snapshot["pages_done"]
+                    self.totals["bytes"] += snapshot["bytes"]
+
+    def job(self, id):
+        with self.lock:
+            return self.jobs.get(id)
+
+    def list_jobs(self):
+        with self.lock:
+            return [job.status() for job in self.jobs.values()]
+
+    def metrics(self):
+        with self.lock:
+            states = {}
+            for job in self.jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+            totals = dict(self.totals)
+        uptime = time.time() - self.started
+        return {
+            "uptime": round(uptime, 1),
+            "jobs": states,
+            "queued": self.pending.qsize(),
+            "docs_done": totals["docs"],
+            "pages_done": totals["pages"],
+            "bytes": totals["bytes"],
+            "bytes_per_second": round(totals["bytes"] / max(uptime, 1e-6)),
+            "item_cache": {
+                "size": len(self.client.items),
+                "hits": self.client.items.hits,
+                "misses": self.client.items.misses,
+            },
+            "response_cache": {
+                "size": len(self.client.responses),
+                "hits": self.client.responses.hits,
+                "misses": self.client.responses.misses,
+            },
+            "shared_requests": self.client.flights.shared,
+        }
+
+    def close(self):
+        for runner in self.runners:
+            self.pending.put(None)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        log.debug("%s %s" % (self.address_string(), format % args))
+
+    def _send(self, code, data):
+        body = json.dumps(data, default=str).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path == "/jobs":
+            self._send(200, self.service.list_jobs())
+        elif path.startswith("/jobs/"):
+            job = self.service.job(path[len("/jobs/") :])
+            if job:
+                self._send(200, job.status())
+            else:
+                self._send(404, {"error": "no such job"})
+        elif path == "/metrics":
+            self._send(200, self.service.metrics())
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self._send(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            job = self.service.submit(request.get("args"))
+        except (ValueError, AttributeError) as e:
+            self._send(400, {"error": str(e)})
+            return
+        self._send(202, job.status())
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(address, service):
+    """Return an HTTP server for service at host:port or unix:/path."""
+    handler = type("Handler", (JobRequestHandler,), {"service": service})
+    if address.startswith("unix:"):
+        path = address[len("unix:") :]
+        if os.path.exists(path):
+            os.remove(path)
+        return UnixHTTPServer(path, handler)
+    host, _, port = address.rpartition(":")
+    return ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+
+
+def serve(address, parse_args, jobs=2):
+    """Run the job API at address until interrupted."""
+    service = JobService(parse_args, jobs=jobs)
+    server = make_server(address, service)
+    log.info("Serving ppolona jobs at %s" % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if address.startswith("unix:"):
+            os.remove(address[len("unix:") :])
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+pypolona.storage
+----------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Writing downloaded files to disk.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+
+log = logging.getLogger("pypolona")
+
+
+class NotEnoughSpace(Exception):
+    def __init__(self, path, needed, free):
+        self.path = path
+        self.needed = needed
+        self.free = free
+        super().__init__(
+            "Need %s but only %s free in %s"
+            % (format_size(needed), format_size(free), path)
+        )
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f TB" % size
+
+
+def free_space(path):
+    return shutil.disk_usage(path).free
+
+
+def preallocate(fileobj, size):
+    """Reserve `size` bytes for `fileobj` in one go, where supported.
+
+    This fails up front with ENOSPC instead of leaving a half-written
+    file, and lets the filesystem allocate contiguous extents.
+    """
+    if size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fileobj.fileno(), 0, size)
+        except OSError as e:
+            # Filesystems without fallocate support just write normally
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+
+def write_file(path, data, prealloc=False):
+    """Write data to path through a `.part` file that replaces path when
+    complete, so that path never holds a half-written file.
+    """
+    part_path = path + ".part"
+    try:
+        with open(part_path, "wb") as outfile:
+            if prealloc:
+                preallocate(outfile, len(data))
+            outfile.write(data)
+        os.replace(part_path, path)
+    except BaseException:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_checksum(path):
+    """Write the SHA-256 of the file at path to `<path>.sha256` in the
+    format of `sha256sum`, and return it.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1024 * 1024), b""):
+            digest.update(chunk)
+    checksum = digest.hexdigest()
+    line = "%s  %s\n" % (checksum, os.path.basename(path))
+    write_file(path + ".sha256", line.encode("utf-8"))
+    return checksum
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+pypolona.sync
+-------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Persistent state for incremental (`--sync`) runs of saved searches.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import os.path
+
+log = logging.getLogger("pypolona")
+
+
+def search_key(url):
+    """Short stable key for a normalized search URL."""
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+
+
+class SyncState:
+    """High-water mark of a saved search, stored as JSON.
+
+    The state records every ID that has been reported or downloaded by
+    previous runs (`seen`), plus the full result set of the last run
+    (`results`) and the IDs that were new in it (`new`).
+    """
+
+    def __init__(self, path, query_url):
+        self.path = path
+        self.query_url = query_url
+        self.seen = []
+        self.results = []
+        self.new = []
+        self.last_run = None
+        self.previous_run = None
+        self._seen_set = set()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError) as e:
+            log.warning("Cannot read sync state file://%s: %s" % (self.path, e))
+            return
+        if state.get("query_url") != self.query_url:
+            log.warning("Sync state file://%s belongs to another search" % self.path)
+            return
+        self.seen = state.get("seen", [])
+        self.results = state.get("results", [])
+        self.new = state.get("new", [])
+        self.last_run = state.get("last_run", None)
+        self._seen_set = set(self.seen)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        state = {
+            "query_url": self.query_url,
+            "last_run": self.last_run,
+            "seen": self.seen,
+            "results": self.results,
+            "new": self.new,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as state_file:
+            json.dump(state, state_file, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def update(self, ids):
+        """Record the current result set, return the IDs not seen before."""
+        self.results = list(ids)
+        self.new = [id for id in ids if id not in self._seen_set]
+        self.previous_run = self.last_run
+        self.last_run = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        return self.new
+
+    def mark(self, ids):
+        """Advance the high-water mark past the given IDs."""
+        for id in ids:
+            if id not in self._seen_set:
+                self._seen_set.add(id)
+                self.seen.append(id)
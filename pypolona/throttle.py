@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+pypolona.throttle
+-----------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Bandwidth limit for `--limit-rate`, shared fairly by concurrent docs.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class RateLimiter:
+    """Token bucket of `rate` bytes per second with a fair-share queue.
+
+    Every thread downloads one doc at a time. When several threads wait
+    for bandwidth, the one whose doc has received the fewest bytes so far
+    goes first, so a huge doc cannot starve small ones. Bytes are paid
+    for after they are received, one chunk of a response at a time: a
+    chunk may put the bucket into debt, and the next chunk is only read
+    once it is paid off.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.served = {}
+        self.seq = itertools.count()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def start_doc(self):
+        """Start counting the bytes of a new doc in the calling thread."""
+        with self.cond:
+            self.served[threading.get_ident()] = 0
+
+    def consume(self, nbytes):
+        """Account for nbytes received, waiting for bandwidth first."""
+        key = threading.get_ident()
+        with self.cond:
+            entry = (self.served.get(key, 0), next(self.seq), key)
+            heapq.heappush(self.waiting, entry)
+            while True:
+                self._refill()
+                if self.waiting[0] is entry and self.tokens > 0:
+                    heapq.heappop(self.waiting)
+                    self.tokens -= nbytes
+                    self.served[key] = self.served.get(key, 0) + nbytes
+                    self.cond.notify_all()
+                    return
+                if self.waiting[0] is entry:
+                    self.cond.wait(timeout=-self.tokens / self.rate + 0.001)
+                else:
+                    self.cond.wait(timeout=1.0)
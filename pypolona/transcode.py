@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+pypolona.transcode
+------------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Optional re-encoding of downloaded scans before they go into a PDF:
+downscaling to a target DPI, grayscale or bitonal conversion, and JPEG
+or JPEG 2000 compression.
+"""
+
+import io
+import logging
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+log = logging.getLogger("pypolona")
+
+# Assumed resolution of scans that do not record their DPI
+DEFAULT_SCAN_DPI = 300
+# Mean channel spread below which "auto" treats a page as colorless
+GRAY_THRESHOLD = 6
+
+
+def is_grayish(im):
+    """Guess whether a scan is a colorless page such as printed text."""
+    rgb = im.convert("RGB").resize((64, 64)).tobytes()
+    spread = [max(rgb[i : i + 3]) - min(rgb[i : i + 3]) for i in range(0, len(rgb), 3)]
+    return sum(spread) / len(spread) < GRAY_THRESHOLD
+
+
+def jp2_with_dpi(data, dpi):
+    """Add a capture resolution of dpi to the header of the JP2 data.
+
+    Pillow writes JPEG 2000 without a resolution, and img2pdf would then
+    lay the page out at its default DPI instead of the scan's.
+    """
+    pos = 0
+    while pos + 8 <= len(data):
+        length, box = struct.unpack(">I4s", data[pos : pos + 8])
+        if length < 8:
+            break
+        if box == b"jp2h" and b"res " not in data[pos + 8 : pos + length]:
+            # Grid points per metre as num / den * 10 ** exp
+            if dpi * 50 <= 0xFFFF:
+                num, den, exp = dpi * 50, 127, 2
+            else:
+                num, den, exp = round(dpi * 100 / 2.54), 1, 0
+            resc = struct.pack(">I4sHHHHBB", 18, b"resc", num, den, num, den, exp, exp)
+            res = struct.pack(">I4s", 8 + len(resc), b"res ") + resc
+            header = struct.pack(">I4s", length + len(res), b"jp2h")
+            end = pos + length
+            return data[:pos] + header + data[pos + 8 : end] + res + data[end:]
+        pos += length
+    return data
+
+
+def transcode_image(data, dpi=0, color="keep", quality=0, jp2=False):
+    """Re-encode one scan, return the new image bytes.
+
+    `dpi` downscales (never upscales) to that resolution, `color` is one of
+    keep, gray, bitonal or auto (gray for colorless pages), `quality` is
+    the JPEG quality (0: Pillow default) and `jp2` writes JPEG 2000.
+    Bitonal pages are written as CCITT G4 TIFF, which img2pdf embeds as is.
+    """
+    from PIL import Image
+
+    im = Image.open(io.BytesIO(data))
+    im.load()
+    source_dpi = im.info.get("dpi", (DEFAULT_SCAN_DPI, DEFAULT_SCAN_DPI))[0]
+    source_dpi = int(round(source_dpi)) or DEFAULT_SCAN_DPI
+    out_dpi = source_dpi
+    if dpi and dpi < source_dpi:
+        scale = dpi / source_dpi
+        size = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+        im = im.resize(size, Image.LANCZOS)
+        out_dpi = dpi
+    if color == "auto":
+        color = "gray" if im.mode == "L" or is_grayish(im) else "keep"
+    if color in ("gray", "bitonal"):
+        im = im.convert("L")
+    out = io.BytesIO()
+    if color == "bitonal":
+        im = im.point(lambda v: 255 if v > 127 else 0).convert("1")
+        im.save(out, format="TIFF", compression="group4", dpi=(out_dpi, out_dpi))
+    elif jp2:
+        im.save(
+            out,
+            format="JPEG2000",
+            quality_mode="dB",
+            quality_layers=[quality / 2 if quality else 38],
+        )
+        return jp2_with_dpi(out.getvalue(), out_dpi)
+    else:
+        if im.mode not in ("L", "RGB"):
+            im = im.convert("RGB")
+        options = {"quality": quality} if quality else {}
+        im.save(out, format="JPEG", optimize=True, dpi=(out_dpi, out_dpi), **options)
+    return out.getvalue()
+
+
+def _transcode_args(args):
+    data, settings = args
+    return transcode_image(data, **settings)
+
+
+class Transcoder:
+    """Transcode scans in a pool of worker processes."""
+
+    def __init__(self, processes=None, **settings):
+        self.settings = settings
+        self.processes = processes
+        self.pool = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def transcode(self, images):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.processes)
+        results = list(
+            self.pool.map(
+                _transcode_args, [(data, self.settings) for data in images], chunksize=4
+            )
+        )
+        size_in = sum(len(data) for data in images)
+        size_out = sum(len(data) for data in results)
+        self.bytes_in += size_in
+        self.bytes_out += size_out
+        return results, size_in, size_out
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
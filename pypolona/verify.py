@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+pypolona.verify
+---------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Checks of existing downloads for `--verify`: JPEG start/end markers,
+page counts against the sidecar and the `dc:identifier` of PDFs.
+"""
+
+import logging
+import os
+import os.path
+from concurrent.futures import ProcessPoolExecutor
+
+import pikepdf
+
+try:
+    from .library import iter_library, read_sidecar
+except ImportError:
+    from pypolona.library import iter_library, read_sidecar
+
+log = logging.getLogger("pypolona")
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+
+
+def jpeg_complete(path):
+    """Check that the file at path starts and ends like a whole JPEG."""
+    try:
+        with open(path, "rb") as jpeg:
+            head = jpeg.read(2)
+            jpeg.seek(0, os.SEEK_END)
+            jpeg.seek(max(jpeg.tell() - 32, 0))
+            tail = jpeg.read()
+    except OSError:
+        return False
+    # Some encoders pad the file after the end marker
+    return head == JPEG_SOI and tail.rstrip(b"\0\r\n").endswith(JPEG_EOI)
+
+
+def jpeg_size(data):
+    """Return the (width, height) in the frame header of JPEG data, or None."""
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte before the marker
+            pos += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if pos + 9 > len(data):
+                return None
+            height = int.from_bytes(data[pos + 5 : pos + 7], "big")
+            width = int.from_bytes(data[pos + 7 : pos + 9], "big")
+            return width, height
+        pos += 2 + int.from_bytes(data[pos + 2 : pos + 4], "big")
+    return None
+
+
+def jpeg_problem(data, length=None):
+    """Return what is wrong with downloaded JPEG data, or None.
+
+    `length` is the Content-Length of the response, if it was sent.
+    """
+    if length is not None and len(data) != length:
+        return "got %d of %d bytes" % (len(data), length)
+    if not data.startswith(JPEG_SOI):
+        return "not a JPEG"
+    if not data[-32:].rstrip(b"\0\r\n").endswith(JPEG_EOI):
+        return "JPEG is truncated"
+    size = jpeg_size(data)
+    if not size or not all(size):
+        return "JPEG has no image size"
+    return None
+
+
+def expected_pages(hit):
+    """Return the page numbers that were downloaded for hit."""
+    if hit.get("selected_pages"):
+        return list(hit["selected_pages"])
+    return list(range(1, len(hit.get("scans", None) or []) + 1))
+
+
+def verify_item(kind, id, path, sidecar):
+    """Return the list of problems of one saved item, empty if it is complete."""
+    hit = read_sidecar(sidecar) if sidecar else None
+    if sidecar and not hit:
+        return ["unreadable sidecar %s" % sidecar]
+    if kind == "folder" and not hit.get("scans", None):
+        return ["no scans listed in %s" % sidecar]
+    pages = expected_pages(hit) if hit else None
+    problems = []
+    if kind == "folder":
+        for page in pages:
+            jpeg_path = os.path.join(path, "%s-%04d.jpg" % (id, page))
+            if not jpeg_complete(jpeg_path):
+                problems.append("incomplete or missing %s" % jpeg_path)
+        return problems
+    if not os.path.exists(path):
+        return ["missing %s" % path]
+    try:
+        with pikepdf.open(path) as pdf:
+            page_count = len(pdf.pages)
+            identifier = pdf.open_metadata().get("dc:identifier", None)
+    except Exception as e:
+        return ["unreadable %s: %s" % (path, e)]
+    if pages is not None and page_count != len(pages):
+        problems.append("%s has %d of %d pages" % (path, page_count, len(pages)))
+    elif not page_count:
+        problems.append("%s has no pages" % path)
+    if identifier != id:
+        problems.append("%s has dc:identifier %r" % (path, identifier))
+    return problems
+
+
+def _verify_args(item):
+    hit = read_sidecar(item.sidecar) if item.sidecar else None
+    slug = hit.get("slug", "") if hit else ""
+    return item.id, slug, verify_item(item.kind, item.id, item.path, item.sidecar)
+
+
+def verify_library(roots, processes=None):
+    """Check all items saved under roots in parallel.
+
+    Returns the number of items checked and {id: (slug, [problems])} of the
+    incomplete items.
+    """
+    items = [item for root in roots for item in iter_library(root)]
+    broken = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for id, slug, problems in pool.map(_verify_args, items, chunksize=16):
+            if problems:
+                broken.setdefault(id, (slug, []))[1].extend(problems)
+    return len(items), broken
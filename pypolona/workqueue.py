@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+pypolona.workqueue
+------------------
+Copyright (c) 2020 Adam Twardoch <adam+github@twardoch.com>
+MIT license. Python 3.8+
+
+Shared work queue of Polona IDs for `--queue` / `--workers` runs.
+
+Any number of processes, on one or more hosts, can work the same queue.
+Each ID is leased to one worker at a time. A lease that is not renewed
+before it expires (because the worker died) is handed out again, up to
+`max_attempts` times.
+"""
+
+import abc
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger("pypolona")
+
+QUEUE_BACKENDS = {}
+
+
+def register_queue_backend(scheme, cls):
+    """Make `cls` available for queue locations like `scheme://...`.
+
+    `cls` is called with the full location string and must implement
+    the `WorkQueue` methods.
+    """
+    QUEUE_BACKENDS[scheme] = cls
+
+
+def open_queue(location, **kwargs):
+    """Open the queue at `location`: a path, `sqlite:///path` or `scheme://...`."""
+    scheme, sep, rest = location.partition("://")
+    if not sep:
+        return SQLiteQueue(location, **kwargs)
+    if scheme == "sqlite":
+        return SQLiteQueue(rest, **kwargs)
+    if scheme in QUEUE_BACKENDS:
+        return QUEUE_BACKENDS[scheme](location, **kwargs)
+    raise ValueError("Unknown queue backend: %s" % scheme)
+
+
+class WorkQueue(abc.ABC):
+    """Interface of a queue backend."""
+
+    @abc.abstractmethod
+    def put(self, ids):
+        """Add IDs to the queue. IDs already queued are left alone."""
+
+    @abc.abstractmethod
+    def lease(self, worker):
+        """Lease the next available ID to `worker`, or return None."""
+
+    @abc.abstractmethod
+    def renew(self, id, worker):
+        """Extend the lease of `worker` on `id`."""
+
+    @abc.abstractmethod
+    def complete(self, id, worker):
+        """Mark `id` as done."""
+
+    @abc.abstractmethod
+    def fail(self, id, worker, error=""):
+        """Return `id` to the queue, or give up on it after too many attempts."""
+
+    @abc.abstractmethod
+    def release(self, id, worker):
+        """Return `id` to the queue without using up an attempt."""
+
+    @abc.abstractmethod
+    def done(self, ids):
+        """Return those of `ids` that have been completed."""
+
+    @abc.abstractmethod
+    def counts(self):
+        """Return a dict of the number of IDs per state."""
+
+    def close(self):
+        pass
+
+
+class SQLiteQueue(WorkQueue):
+    """Work queue in an SQLite file, for workers sharing a filesystem."""
+
+    def __init__(self, path, lease_time=600, max_attempts=3):
+        self.path = os.path.abspath(path)
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            " id TEXT PRIMARY KEY,"
+            " state TEXT NOT NULL DEFAULT 'pending',"
+            " worker TEXT,"
+            " lease_until REAL NOT NULL DEFAULT 0,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " error TEXT)"
+        )
+
+    def put(self, ids):
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.executemany(
+            "INSERT OR IGNORE INTO items (id) VALUES (?)", [(id,) for id in ids]
+        )
+        self.db.execute("COMMIT")
+
+    def lease(self, worker):
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            # Expired leases of dead workers that used up their attempts
+            self.db.execute(
+                "UPDATE items SET state = 'failed', error = 'lease expired'"
+                " WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            row = self.db.execute(
+                "SELECT id FROM items WHERE state = 'pending'"
+                " OR (state = 'leased' AND lease_until < ?)"
+                " ORDER BY rowid LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row:
+                self.db.execute(
+                    "UPDATE items SET state = 'leased', worker = ?, lease_until = ?,"
+                    " attempts = attempts + 1 WHERE id = ?",
+                    (worker, now + self.lease_time, row[0]),
+                )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return row[0] if row else None
+
+    def renew(self, id, worker):
+        self.db.execute(
+            "UPDATE items SET lease_until = ?"
+            " WHERE id = ? AND worker = ? AND state = 'leased'",
+            (time.time() + self.lease_time, id, worker),
+        )
+
+    def complete(self, id, worker):
+        self.db.execute(
+            "UPDATE items SET state = 'done', lease_until = 0, error = NULL"
+            " WHERE id = ?",
+            (id,),
+        )
+
+    def fail(self, id, worker, error=""):
+        self.db.execute(
+            "UPDATE items SET lease_until = 0, error = ?,"
+            " state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END"
+            " WHERE id = ? AND worker = ?",
+            (error, self.max_attempts, id, worker),
+        )
+
+    def release(self, id, worker):
+        self.db.execute(
+            "UPDATE items SET state = 'pending', lease_until = 0,"
+            " attempts = MAX(attempts - 1, 0)"
+            " WHERE id = ? AND worker = ? AND state = 'leased'",
+            (id, worker),
+        )
+
+    def done(self, ids):
+        done = {
+            row[0]
+            for row in self.db.execute("SELECT id FROM items WHERE state = 'done'")
+        }
+        return [id for id in ids if id in done]
+
+    def counts(self):
+        return dict(
+            self.db.execute("SELECT state, COUNT(*) FROM items GROUP BY state")
+        )
+
+    def close(self):
+        self.db.close()
+
+
+class LeaseKeeper(threading.Thread):
+    """Keep renewing a lease while the worker is alive and busy with it."""
+
+    def __init__(self, queue_location, id, worker, lease_time):
+        super().__init__(daemon=True)
+        self.queue_location = queue_location
+        self.id = id
+        self.worker = worker
+        self.lease_time = lease_time
+        self.stopped = threading.Event()
+
+    def run(self):
+        queue = open_queue(self.queue_location, lease_time=self.lease_time)
+        interval = max(1, self.lease_time / 3)
+        try:
+            while not self.stopped.wait(interval):
+                queue.renew(self.id, self.worker)
+        finally:
+            queue.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
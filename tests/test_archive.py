@@ -0,0 +1,61 @@
+# this_file: tests/test_archive.py
+"""Test the CBZ/ZIP/tar archive outputs."""
+
+import io
+import tarfile
+import zipfile
+
+from pypolona.archive import open_archive
+from pypolona.polona import Polona
+
+from .test_client import make_client
+
+
+def make_polona(download_dir, **opts):
+    client, session = make_client()
+    polona = Polona(
+        client=client,
+        **{
+            "download": True,
+            "download_dir": download_dir,
+            "max_pages": 0,
+            "images": False,
+            "textpdf_skip": True,
+            "skip": False,
+            "progress": "none",
+            **opts,
+        }
+    )
+    polona.ids = ["abc"]
+    return polona
+
+
+def test_archive_is_renamed_when_closed(tmp_path):
+    """Test that unfinished archives only exist as .part files."""
+    path = str(tmp_path / "doc.zip")
+    archive = open_archive("zip", path)
+    archive.add("doc/a.jpg", b"\xff\xd8\xff\xd9")
+    assert not (tmp_path / "doc.zip").exists()
+    archive.close()
+    assert zipfile.ZipFile(path).namelist() == ["doc/a.jpg"]
+    assert not (tmp_path / "doc.zip.part").exists()
+
+
+def test_cbz_output(tmp_path):
+    """Test that a doc is saved as one CBZ with the --images layout."""
+    make_polona(str(tmp_path), format_out="cbz", pages="2").download()
+    names = zipfile.ZipFile(str(tmp_path / "1901--test-doc--abc.cbz")).namelist()
+    assert names == ["1901--test-doc--abc/abc.yaml", "1901--test-doc--abc/abc-0002.jpg"]
+
+
+def test_tar_to_stdout(tmp_path, monkeypatch):
+    """Test streaming all docs as one tar to stdout."""
+    stdout = io.TextIOWrapper(io.BytesIO())
+    monkeypatch.setattr("sys.stdout", stdout)
+    make_polona("-", format_out="tar", progress="gooey").download()
+    tar = tarfile.open(fileobj=io.BytesIO(stdout.buffer.getvalue()))
+    assert tar.getnames() == [
+        "1901--test-doc--abc/abc.yaml",
+        "1901--test-doc--abc/abc-0001.jpg",
+        "1901--test-doc--abc/abc-0002.jpg",
+    ]
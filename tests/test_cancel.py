@@ -0,0 +1,118 @@
+# this_file: tests/test_cancel.py
+"""Test stopping a download and continuing it in the next run."""
+
+import io
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pikepdf
+import pytest
+
+from pypolona.polona import Cancelled, Polona
+from pypolona.storage import write_file
+
+from .test_client import make_client
+
+
+def make_polona(tmp_path, images):
+    client, session = make_client()
+    polona = Polona(
+        client=client,
+        download=True,
+        download_dir=str(tmp_path),
+        max_pages=0,
+        images=images,
+        textpdf_skip=True,
+        skip=True,
+        progress="none",
+    )
+    polona.ids = ["abc"]
+    return polona, session
+
+
+def cancel_after_first_scan(polona, session):
+    get = session.get
+
+    def get_and_cancel(url, **kwargs):
+        if url == "scan1":
+            polona.cancelled.set()
+        return get(url, **kwargs)
+
+    session.get = get_and_cancel
+
+
+@pytest.mark.parametrize("images", [False, True])
+def test_cancelled_download_resumes(tmp_path, images):
+    """Test that a stopped doc is checkpointed and finished by the next run."""
+    polona, session = make_polona(tmp_path, images=images)
+    cancel_after_first_scan(polona, session)
+    with pytest.raises(Cancelled):
+        polona.download()
+    checkpoint = tmp_path / ".pypolona" / "partial" / "abc"
+    assert checkpoint.is_dir()
+    assert not (tmp_path / "1901--test-doc--abc.pdf").exists()
+    assert "scan2" not in session.urls
+
+    polona, session = make_polona(tmp_path, images=images)
+    polona.download()
+    assert polona.done_ids == ["abc"]
+    assert "scan1" not in session.urls and "scan2" in session.urls
+    assert not checkpoint.exists()
+    if images:
+        assert (tmp_path / "1901--test-doc--abc" / "abc-0001.jpg").exists()
+        assert (tmp_path / "1901--test-doc--abc" / "abc-0002.jpg").exists()
+    else:
+        pdf = pikepdf.open(io.BytesIO((tmp_path / "1901--test-doc--abc.pdf").read_bytes()))
+        assert len(pdf.pages) == 2
+
+
+def test_write_file_is_atomic(tmp_path):
+    """Test that a failed write leaves neither a partial file nor a .part."""
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(b"old")
+    with patch("os.replace", side_effect=KeyboardInterrupt):
+        with pytest.raises(KeyboardInterrupt):
+            write_file(str(path), b"new")
+    assert path.read_bytes() == b"old"
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_cancelled_coordinator_stops_workers(tmp_path):
+    """Test that stopping the --workers coordinator terminates its workers."""
+    polona = Polona(
+        client=make_client()[0],
+        download=True,
+        download_dir=str(tmp_path),
+        queue=str(tmp_path / "queue.sqlite"),
+        workers=2,
+        progress="none",
+    )
+    polona.ids = ["abc", "def"]
+    workers = []
+
+    class FakeProcess:
+        def __init__(self, target, args):
+            self.alive = True
+            self.terminated = False
+            workers.append(self)
+
+        def start(self):
+            pass
+
+        def is_alive(self):
+            return self.alive
+
+        def join(self, timeout=None):
+            # The Stop button sends SIGTERM to the coordinator only
+            polona.cancelled.set()
+
+        def terminate(self):
+            self.terminated = True
+            self.alive = False
+
+    context = SimpleNamespace(Process=FakeProcess)
+    with patch("multiprocessing.get_context", return_value=context):
+        with pytest.raises(Cancelled):
+            polona.download()
+    assert len(workers) == 2
+    assert all(worker.terminated for worker in workers)
@@ -134,4 +134,45 @@ def test_main_download_execution(mock_polona_class):
     
     # Verify Polona was instantiated and called correctly
     mock_polona_class.assert_called_once()
-    mock_polona.run.assert_called_once()
\ No newline at end of file
+    mock_polona.run.assert_called_once()
+
+def test_parser_sync_option():
+    """Test parsing the incremental sync option."""
+    parser = cli()
+
+    args = parser.parse_args(["--search", "--sync", "--download", "test"])
+    assert args.sync is True
+    assert parser.parse_args(["test"]).sync is False
+
+
+def test_parser_page_selection():
+    """Test parsing page ranges and sampling."""
+    parser = cli()
+
+    args = parser.parse_args(["--pages", "1-5,100,-3", "--every", "2", "test"])
+    assert args.pages == "1-5,100,-3"
+    assert args.every == 2
+
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--pages", "1-x", "test"])
+
+
+def test_parser_resolution():
+    """Test parsing the scan resolution option."""
+    parser = cli()
+
+    assert parser.parse_args(["test"]).resolution == "max"
+    assert parser.parse_args(["--resolution", "800", "test"]).resolution == "800"
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--resolution", "huge", "test"])
+
+
+def test_parser_local_index():
+    """Test parsing the local index options."""
+    parser = cli()
+
+    args = parser.parse_args(["--index", "/tmp/polona"])
+    assert args.index is True
+    args = parser.parse_args(["--search", "--local", "--index-db", "i.sqlite", "test"])
+    assert args.local is True
+    assert args.index_db == "i.sqlite"
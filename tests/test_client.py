@@ -0,0 +1,224 @@
+# this_file: tests/test_client.py
+"""Test the reusable PolonaClient against a fake HTTP session."""
+
+import io
+import threading
+import time
+
+import pikepdf
+from PIL import Image
+
+from pypolona.client import API_URL, PolonaClient
+from pypolona.verify import jpeg_problem, jpeg_size
+
+
+def make_jpeg():
+    out = io.BytesIO()
+    Image.new("RGB", (20, 30), (255, 255, 255)).save(out, "JPEG")
+    return out.getvalue()
+
+
+class FakeResponse:
+    def __init__(self, json=None, content=b"", content_type="application/json"):
+        self._json = json
+        self.content = content
+        self.text = ""
+        self.headers = {"content-type": content_type}
+        self.ok = True
+
+    def iter_content(self, chunk_size=1):
+        for pos in range(0, len(self.content), chunk_size):
+            yield self.content[pos : pos + chunk_size]
+
+    def json(self):
+        if self._json is None:
+            raise ValueError("no JSON")
+        return self._json
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = responses
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return self.responses[url]
+
+
+ITEM = {
+    "id": "abc",
+    "slug": "test-doc",
+    "title": "Test Doc",
+    "date": "1901-01-01",
+    "categories": ["books"],
+    "resources": [],
+    "scans": [
+        {"resources": [{"mime": "image/jpeg", "url": "scan1", "width": 20}]},
+        {"resources": [{"mime": "image/jpeg", "url": "scan2", "width": 20}]},
+    ],
+}
+
+
+def make_client():
+    jpeg = make_jpeg()
+    session = FakeSession(
+        {
+            API_URL + "abc": FakeResponse(ITEM),
+            "scan1": FakeResponse(content=jpeg, content_type="image/jpeg"),
+            "scan2": FakeResponse(content=jpeg, content_type="image/jpeg"),
+        }
+    )
+    return PolonaClient(session=session), session
+
+
+def test_iter_search():
+    """Test that search hits are yielded with their item URLs."""
+    client = PolonaClient(session=None)
+    url = client.search_url(["foo", "bar"], languages=["polski"], advanced=True)
+    assert "query=foo+bar" in url
+    assert "advanced=1" in url
+    assert "filters[language][]=polski" in url
+    client.session = FakeSession(
+        {url: FakeResponse({"hits": [{"id": "abc", "slug": "test-doc", "date": "1901"}]})}
+    )
+    hits = list(client.iter_search("foo bar", languages=["polski"], advanced=True))
+    assert [hit.id for hit in hits] == ["abc"]
+    assert hits[0].year == 1901
+    assert hits[0].url == "https://polona.pl/item/test-doc,abc/"
+
+
+
+def test_iter_search_all_pages():
+    """Test that all result pages are read until a short one."""
+    client = PolonaClient(session=None)
+    url = client.search_url("foo", size=2)
+
+    def page(*ids):
+        return FakeResponse({"hits": [{"id": id, "slug": id} for id in ids]})
+
+    client.session = FakeSession(
+        {url: page("a", "b"), url + "&from=2": page("c", "d"), url + "&from=4": page("e")}
+    )
+    assert [hit.id for hit in client.iter_search_all(url)] == list("abcde")
+    # A page of hits seen before ends the search
+    client.session = FakeSession({url: page("a", "b"), url + "&from=2": page("a", "b")})
+    assert [hit.id for hit in client.iter_search_all(url)] == ["a", "b"]
+
+def test_get_item_is_cached():
+    """Test that items are processed and fetched only once per client."""
+    client, session = make_client()
+    item = client.get_item("abc")
+    assert item.subdir == "1901--test-doc--abc"
+    assert client.get_item("abc") is item
+    assert session.urls == [API_URL + "abc"]
+
+
+def test_iter_pages_and_build_pdf():
+    """Test downloading selected pages and building a PDF with metadata."""
+    client, session = make_client()
+    item = client.get_item("abc")
+    pages = list(client.iter_pages(item, [1]))
+    assert [idx for idx, data in pages] == [1]
+    assert session.urls[-1] == "scan2"
+
+    pdf = pikepdf.open(io.BytesIO(client.build_pdf(item, [data for idx, data in pages])))
+    assert len(pdf.pages) == 1
+    assert pdf.open_metadata()["dc:identifier"] == "abc"
+
+
+def test_build_pdf_linearized():
+    """Test saving a linearized PDF with object streams."""
+    client, session = make_client()
+    item = client.get_item("abc")
+    pages = [data for idx, data in client.iter_pages(item)]
+    data = client.build_pdf(item, pages, linearize=True, object_streams=True)
+    assert b"/Linearized" in data[:1024]
+    assert b"/ObjStm" in data
+    pdf = pikepdf.open(io.BytesIO(data))
+    assert len(pdf.pages) == 2
+    assert pdf.open_metadata()["dc:identifier"] == "abc"
+
+
+class SlowSession(FakeSession):
+    def get(self, url, **kwargs):
+        time.sleep(0.05)
+        return super().get(url, **kwargs)
+
+
+def test_concurrent_requests_are_merged():
+    """Test that concurrent lookups of one item make one request."""
+    client, session = make_client()
+    client.session = SlowSession(session.responses)
+    items = []
+    threads = [
+        threading.Thread(target=lambda: items.append(client.get_item("abc")))
+        for n in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.session.urls == [API_URL + "abc"]
+    assert all(item is items[0] for item in items)
+
+
+def test_small_responses_are_memoized():
+    """Test that memo GETs are answered from memory."""
+    client, session = make_client()
+    client.get(API_URL + "abc", memo=True)
+    client.get(API_URL + "abc", memo=True)
+    client.get("scan1")
+    client.get("scan1")
+    assert session.urls == [API_URL + "abc", "scan1", "scan1"]
+
+
+def test_prefetcher_fills_item_cache():
+    """Test that upcoming items are fetched ahead, each only once."""
+    from pypolona.polona import Prefetcher
+
+    client, session = make_client()
+    prefetcher = Prefetcher(client, lookahead=2)
+    prefetcher.fetch(["abc", "abc", "missing"])
+    prefetcher.fetch(["abc"])
+    prefetcher.pool.shutdown(wait=True)
+    assert "abc" in client.items
+    assert session.urls == [API_URL + "abc"]
+
+
+class FlakySession(FakeSession):
+    """Returns a truncated JPEG for the first request of each scan."""
+
+    def get(self, url, **kwargs):
+        r = super().get(url, **kwargs)
+        if url.startswith("scan") and self.urls.count(url) == 1:
+            return FakeResponse(content=r.content[:-10], content_type="image/jpeg")
+        return r
+
+
+def test_broken_scan_is_downloaded_again():
+    """Test that truncated and wrong-type scans are retried per page."""
+    client, session = make_client()
+    client.session = FlakySession(session.responses)
+    client.retry_delay = 0
+    item = client.get_item("abc")
+    pages = [data for idx, data in client.iter_pages(item)]
+    assert pages == [session.responses["scan1"].content] * 2
+    assert client.session.urls.count("scan1") == 2
+
+    client.session.responses["scan2"] = FakeResponse(content=b"<html>")
+    assert list(client.iter_pages(item, [1], retries=1)) == [(1, None)]
+    assert client.session.urls.count("scan2") == 4
+
+
+def test_jpeg_problem():
+    """Test the checks of downloaded JPEG data."""
+    jpeg = make_jpeg()
+    assert jpeg_problem(jpeg) is None
+    assert jpeg_size(jpeg) == (20, 30)
+    assert jpeg_problem(jpeg, len(jpeg) + 1) == "got %d of %d bytes" % (
+        len(jpeg),
+        len(jpeg) + 1,
+    )
+    assert jpeg_problem(jpeg[:-10]) == "JPEG is truncated"
+    assert jpeg_problem(b"GIF89a") == "not a JPEG"
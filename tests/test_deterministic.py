@@ -0,0 +1,43 @@
+# this_file: tests/test_deterministic.py
+"""Test --deterministic output and its content hashes."""
+
+import hashlib
+import time
+
+import pikepdf
+
+from pypolona.retag import retag_pdf
+
+from .test_verify import download
+
+PDF = "1901--test-doc--abc.pdf"
+
+
+def test_same_doc_gives_same_bytes(tmp_path):
+    """Test that two runs make identical PDFs with a sha256sum sidecar."""
+    download(tmp_path / "first", deterministic=True)
+    # img2pdf dates have a resolution of one second
+    time.sleep(1.1)
+    download(tmp_path / "second", deterministic=True)
+    first = (tmp_path / "first" / PDF).read_bytes()
+    assert first == (tmp_path / "second" / PDF).read_bytes()
+    checksum = (tmp_path / "first" / (PDF + ".sha256")).read_text()
+    assert checksum == "%s  %s\n" % (hashlib.sha256(first).hexdigest(), PDF)
+
+    with pikepdf.open(tmp_path / "first" / PDF) as pdf:
+        assert "/CreationDate" not in pdf.docinfo
+        assert "xmp:MetadataDate" not in pdf.open_metadata()
+
+
+def test_retag_updates_checksum(tmp_path):
+    """Test that retagging keeps an existing content hash current."""
+    download(tmp_path, deterministic=True)
+    path = str(tmp_path / PDF)
+    from pypolona.library import read_sidecar
+
+    hit = read_sidecar(str(tmp_path / "1901--test-doc--abc.yaml"))
+    hit.title = "Changed"
+    assert retag_pdf(path, hit) == "updated"
+    data = (tmp_path / PDF).read_bytes()
+    checksum = (tmp_path / (PDF + ".sha256")).read_text()
+    assert checksum.split()[0] == hashlib.sha256(data).hexdigest()
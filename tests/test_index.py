@@ -0,0 +1,88 @@
+# this_file: tests/test_index.py
+"""Test the local metadata index of downloaded docs."""
+
+from orderedattrdict import AttrDict as ad
+
+from pypolona.index import MetadataIndex
+from pypolona.library import iter_library, write_sidecar
+from pypolona.polona import Polona
+
+
+def make_library(root):
+    (root / "1890-quo-vadis-abc").mkdir()
+    write_sidecar(
+        str(root / "1890-quo-vadis-abc" / "abc.yaml"),
+        ad(
+            id="abc",
+            title="Quo vadis",
+            slug="quo-vadis",
+            date="1896",
+            creator_name="Sienkiewicz, Henryk",
+            dc={"language": [{"text": "polski"}]},
+        ),
+    )
+    write_sidecar(
+        str(root / "1900-lalka-def.yaml"),
+        ad(
+            id="def",
+            title="Lalka",
+            slug="lalka",
+            date="1890",
+            creator_name="Prus, Bolesław",
+            keywords=["powieść"],
+            dc={"language": [{"text": "polski"}]},
+        ),
+    )
+
+
+def test_iter_library(tmp_path):
+    """Test finding saved folders and PDFs by their sidecars."""
+    make_library(tmp_path)
+    items = {item.id: item for item in iter_library(str(tmp_path))}
+    assert items["abc"].kind == "folder"
+    assert items["def"].kind == "pdf"
+    assert items["def"].path.endswith("1900-lalka-def.pdf")
+
+
+def test_index_search(tmp_path):
+    """Test ingesting sidecars and searching them offline."""
+    make_library(tmp_path)
+    index = MetadataIndex(str(tmp_path / ".pypolona" / "index.sqlite"))
+    assert index.ingest(str(tmp_path)) == 2
+    assert index.ingest(str(tmp_path)) == 0
+
+    assert [hit.id for hit in index.search("sienkiewicz")] == ["abc"]
+    assert [hit.id for hit in index.search("prus")] == ["def"]
+    assert [hit.id for hit in index.search("powiesc")] == ["def"]
+    query = "lalka OR vadis"
+    assert [hit.id for hit in index.search(query, "date asc", advanced=True)] == [
+        "def",
+        "abc",
+    ]
+    assert len(index.search(query, languages=["polski"], advanced=True)) == 2
+    assert index.search(query, languages=["angielski"], advanced=True) == []
+    hit = index.search("quo vadis")[0]
+    assert hit.year == 1896
+    assert hit.url == "https://polona.pl/item/quo-vadis,abc/"
+    index.close()
+
+
+def test_invalid_local_search(tmp_path, caplog):
+    """Test that a malformed -A query is reported, not raised."""
+    make_library(tmp_path)
+    index_db = str(tmp_path / "index.sqlite")
+    index = MetadataIndex(index_db)
+    index.ingest(str(tmp_path))
+    index.close()
+    polona = Polona(
+        advanced=True,
+        local=True,
+        index_db=index_db,
+        query=["title:(foo"],
+        sort="score desc",
+        search_languages=None,
+        progress="none",
+    )
+    polona.search_local()
+    assert polona.ids == []
+    assert "Invalid search" in caplog.text
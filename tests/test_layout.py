@@ -0,0 +1,35 @@
+# this_file: tests/test_layout.py
+"""Test the sharded download folder layouts."""
+
+from orderedattrdict import AttrDict as ad
+
+from pypolona.library import PathIndex, iter_library, shard_dir
+
+from .test_verify import download
+
+
+def test_shard_dir():
+    """Test the subfolder of each layout."""
+    hit = ad(id="abc", year=1896)
+    assert shard_dir(hit, "flat") == ""
+    assert shard_dir(hit, "year") == "1896"
+    assert shard_dir(hit, "decade") == "1890s"
+    assert shard_dir(ad(id="abc"), "decade") == "undated"
+    assert len(shard_dir(hit, "hash")) == 2
+
+
+def test_sharded_download_uses_path_index(tmp_path):
+    """Test that sharded downloads are recorded and skipped by the index."""
+    download(tmp_path, layout="decade")
+    pdf = tmp_path / "1900s" / "1901--test-doc--abc.pdf"
+    assert pdf.exists()
+    index = PathIndex(str(tmp_path / ".pypolona" / "paths.tsv"))
+    assert index.get("abc") == ["1900s/1901--test-doc--abc.pdf"]
+    assert [item.id for item in iter_library(str(tmp_path))] == ["abc"]
+
+    # -O trusts the index: a listed doc is skipped without looking at it
+    pdf.unlink()
+    download(tmp_path, layout="decade", skip=True)
+    assert not pdf.exists()
+    download(tmp_path, layout="decade")
+    assert pdf.exists()
@@ -0,0 +1,57 @@
+# this_file: tests/test_memo.py
+"""Test the in-process LRU cache and single-flight request merging."""
+
+import threading
+import time
+
+import pytest
+
+from pypolona.memo import LRUCache, SingleFlight
+
+
+def test_lru_cache_evicts_least_recently_used():
+    """Test that the oldest unused entry is dropped first."""
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_single_flight_shares_result_and_errors():
+    """Test that waiting callers get the result or exception of the first."""
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return "data"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do("k", fetch)))
+    leader.start()
+    started.wait()
+    followers = [
+        threading.Thread(target=lambda: results.append(flights.do("k", fetch)))
+        for n in range(3)
+    ]
+    for follower in followers:
+        follower.start()
+    while flights.shared < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+    assert results == ["data"] * 4
+    assert len(calls) == 1
+
+    with pytest.raises(ValueError):
+        flights.do("k", lambda: int("x"))
+    assert flights.do("k", lambda: "again") == "again"
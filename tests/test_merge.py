@@ -0,0 +1,92 @@
+# this_file: tests/test_merge.py
+"""Test merging the PDFs of all docs with --merge-into."""
+
+import os
+
+import pikepdf
+import pytest
+from orderedattrdict import AttrDict as ad
+
+from pypolona.client import API_URL
+from pypolona.merge import PdfMerger
+from pypolona.polona import Polona
+
+from .test_client import ITEM, FakeResponse, make_client
+from .test_verify import download
+
+
+def test_merge_into(tmp_path):
+    """Test that the merged PDF has the pages and a bookmark of every doc."""
+    client, session = make_client()
+    short = dict(ITEM, id="def", slug="short-doc", title="Short", scans=ITEM["scans"][:1])
+    session.responses[API_URL + "def"] = FakeResponse(short)
+    merged_path = tmp_path / "merged.pdf"
+    polona = Polona(
+        client=client,
+        download=True,
+        download_dir=str(tmp_path),
+        max_pages=0,
+        images=False,
+        textpdf_skip=True,
+        skip=False,
+        progress="none",
+        jobs=2,
+        merge_into=str(merged_path),
+    )
+    polona.ids = ["def", "abc"]
+    polona.download()
+
+    with pikepdf.open(merged_path) as pdf:
+        assert len(pdf.pages) == 3
+        with pdf.open_outline() as outline:
+            titles = [item.title for item in outline.root]
+            pages = [
+                pdf.pages.index(item.destination[0]) for item in outline.root
+            ]
+    assert titles == ["Short (1901-01-01)", "Test Doc (1901-01-01)"]
+    assert pages == [0, 1]
+    assert (tmp_path / "1901--short-doc--def.pdf").exists()
+    assert not (tmp_path / "merged.pdf.part").exists()
+
+
+def test_merge_into_refused(tmp_path, caplog):
+    """Test that --merge-into is refused where it cannot be honored."""
+    for opts in ({"queue": str(tmp_path / "queue.sqlite")}, {"download_dir": "-"}):
+        download(tmp_path, merge_into=str(tmp_path / "merged.pdf"), **opts)
+        assert "--merge-into cannot be used" in caplog.text
+        caplog.clear()
+    assert not (tmp_path / "1901--test-doc--abc.pdf").exists()
+    assert not (tmp_path / "queue.sqlite").exists()
+
+
+def test_merge_in_batches(tmp_path):
+    """Test that merging many docs keeps only a batch of files open."""
+    resource = pytest.importorskip("resource")
+    fd_dir = "/proc/self/fd"
+    if not os.path.isdir(fd_dir):
+        pytest.skip("needs /proc/self/fd")
+    ids = ["doc%03d" % n for n in range(60)]
+    for id in ids:
+        pdf = pikepdf.new()
+        pdf.add_blank_page()
+        pdf.save(str(tmp_path / ("%s.pdf" % id)))
+        pdf.close()
+    merged_path = tmp_path / "merged.pdf"
+    merger = PdfMerger(str(merged_path), ids, batch=8)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (len(os.listdir(fd_dir)) + 20, hard))
+    try:
+        for id in ids[:16]:
+            merger.add(ad(id=id, title=id), str(tmp_path / ("%s.pdf" % id)))
+        assert (tmp_path / "merged.pdf.part").exists()
+        # Out of order, as with --jobs
+        for id in ids[17:] + ids[16:17]:
+            merger.add(ad(id=id, title=id), str(tmp_path / ("%s.pdf" % id)))
+        assert merger.close() == 60
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    with pikepdf.open(merged_path) as pdf:
+        assert len(pdf.pages) == 60
+        with pdf.open_outline() as outline:
+            assert [item.title for item in outline.root] == ids
+    assert not (tmp_path / "merged.pdf.part").exists()
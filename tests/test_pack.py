@@ -0,0 +1,33 @@
+# this_file: tests/test_pack.py
+"""Test packing --images folders into PDFs."""
+
+import pikepdf
+
+from pypolona.pack import pack_library
+from pypolona.verify import verify_library
+
+from .test_verify import download
+
+
+def test_pack_images_folder(tmp_path):
+    """Test that a folder becomes a PDF with metadata and a sidecar."""
+    download(tmp_path, images=True)
+    counts = pack_library([str(tmp_path)], processes=1)
+    assert counts == {"packed": 1, "skipped": 0, "failed": 0}
+    with pikepdf.open(str(tmp_path / "1901--test-doc--abc.pdf")) as pdf:
+        assert len(pdf.pages) == 2
+        assert pdf.open_metadata()["dc:identifier"] == "abc"
+    assert (tmp_path / "1901--test-doc--abc.yaml").exists()
+    assert verify_library([str(tmp_path)], processes=1) == (2, {})
+
+    counts = pack_library([str(tmp_path)], processes=1, skip=True)
+    assert counts["skipped"] == 1
+
+
+def test_pack_transcoded(tmp_path):
+    """Test packing with transcoding settings."""
+    download(tmp_path, images=True, pages="1")
+    settings = {"dpi": 0, "color": "gray", "quality": 50, "jp2": False}
+    assert pack_library([str(tmp_path)], processes=1, transcode=settings)["packed"] == 1
+    with pikepdf.open(str(tmp_path / "1901--test-doc--abc.pdf")) as pdf:
+        assert len(pdf.pages) == 1
@@ -0,0 +1,68 @@
+# this_file: tests/test_pages.py
+"""Test page and scan rendition selection."""
+
+import pytest
+
+from pypolona.client import select_scan_resource
+from pypolona.polona import parse_page_ranges, select_pages
+
+
+def test_parse_page_ranges():
+    """Test parsing of single pages, ranges, open ends and tails."""
+    assert parse_page_ranges("1-5,100,-3,200-") == [
+        (1, 5),
+        (100, 100),
+        (-3, None),
+        (200, None),
+    ]
+
+
+@pytest.mark.parametrize("spec", ["", "a", "1-2-3", "5,,6", "--3"])
+def test_parse_page_ranges_rejects_invalid(spec):
+    """Test that malformed specs raise ValueError."""
+    with pytest.raises(ValueError):
+        parse_page_ranges(spec)
+
+
+def test_select_pages_ranges():
+    """Test that ranges select 0-based indices in page order."""
+    ranges = parse_page_ranges("8-,1-3,-2,2")
+    assert select_pages(10, ranges) == [0, 1, 2, 7, 8, 9]
+    # Out-of-range pages are ignored
+    assert select_pages(3, parse_page_ranges("2-10,50")) == [1, 2]
+
+
+def test_select_pages_every_and_max_pages():
+    """Test that sampling and max pages apply to the selection."""
+    assert select_pages(10, every=3) == [0, 3, 6, 9]
+    assert select_pages(10, parse_page_ranges("5-"), every=2) == [4, 6, 8]
+    assert select_pages(10, every=3, max_pages=2) == [0, 3]
+    assert select_pages(10, max_pages=0) == list(range(10))
+
+
+RESOURCES = [
+    {"mime": "image/jpeg", "url": "mid", "width": 1500},
+    {"mime": "image/jpeg", "url": "max", "width": 3000},
+    {"mime": "image/png", "url": "png", "width": 6000},
+    {"mime": "image/jpeg", "url": "min", "width": 300},
+]
+
+
+@pytest.mark.parametrize(
+    "resolution,url",
+    [("max", "max"), ("min", "min"), ("1000", "mid"), ("1500", "mid"), ("9000", "max")],
+)
+def test_select_scan_resource(resolution, url):
+    """Test that exactly one JPEG rendition is chosen per scan."""
+    assert select_scan_resource(RESOURCES, resolution)["url"] == url
+
+
+def test_select_scan_resource_without_sizes():
+    """Test the fallback to list order when renditions have no sizes."""
+    resources = [
+        {"mime": "image/jpeg", "url": "first"},
+        {"mime": "image/jpeg", "url": "second"},
+    ]
+    assert select_scan_resource(resources, "max")["url"] == "first"
+    assert select_scan_resource(resources, "min")["url"] == "second"
+    assert select_scan_resource([{"mime": "image/png", "url": "x"}]) is None
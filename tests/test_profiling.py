@@ -0,0 +1,56 @@
+# this_file: tests/test_profiling.py
+"""Test the profiling hooks."""
+
+import pstats
+
+from pypolona import profiling
+
+from .test_verify import download
+
+
+@profiling.timed
+def double(value):
+    return value * 2
+
+
+def test_timers_only_count_when_enabled():
+    """Test that disabled timers record nothing."""
+    profiling.reset_timers()
+    assert double(2) == 4
+    assert profiling.TIMERS == {}
+    profiling.enable_timers()
+    try:
+        double(2)
+        double(3)
+    finally:
+        profiling.enable_timers(False)
+    assert profiling.TIMERS["double"][0] == 2
+    assert "double" in profiling.format_timers()
+
+
+def test_profile_call(tmp_path):
+    """Test that cpu and mem profiles are saved."""
+    cpu_path = str(tmp_path / "cpu.prof")
+    assert profiling.profile_call("cpu", lambda: double(1), cpu_path) == 2
+    assert pstats.Stats(cpu_path).total_calls > 0
+    mem_path = tmp_path / "mem.txt"
+    assert profiling.profile_call("mem", lambda: [0] * 1000, str(mem_path)) == [0] * 1000
+    assert mem_path.read_text().startswith("Current")
+    assert not profiling._timers_enabled
+
+
+def test_download_is_timed(tmp_path):
+    """Test that the timers cover the functions a download runs."""
+    profiling.reset_timers()
+    profiling.enable_timers()
+    try:
+        download(tmp_path)
+    finally:
+        profiling.enable_timers(False)
+    for name in (
+        "Polona.download_id",
+        "Polona.save_downloaded",
+        "PolonaClient.download_scan",
+        "PolonaClient.build_pdf",
+    ):
+        assert profiling.TIMERS[name][0] >= 1, name
@@ -0,0 +1,87 @@
+# this_file: tests/test_progress.py
+"""Test progress counters and sinks."""
+
+import io
+import json
+import re
+import sys
+
+from pypolona.progress import (
+    GooeySink,
+    JsonSink,
+    Progress,
+    Sink,
+    format_duration,
+    make_progress,
+)
+
+
+class ListSink(Sink):
+    def __init__(self):
+        self.statuses = []
+
+    def write(self, status):
+        self.statuses.append(status)
+
+
+def test_updates_are_throttled():
+    """Test that sinks are not called for every update."""
+    sink = ListSink()
+    progress = Progress([sink], interval=3600)
+    progress.add_docs(2)
+    progress.start_doc(10)
+    for _ in range(10):
+        progress.update(pages=1, bytes=100)
+    assert len(sink.statuses) == 1
+    progress.update(docs=1)
+    progress.close()
+    assert len(sink.statuses) == 2
+    status = sink.statuses[-1]
+    assert status["docs_done"] == 1
+    assert status["pages_done"] == 10
+    assert status["bytes"] == 1000
+
+
+def test_fraction_assumes_average_length_for_unstarted_docs():
+    """Test the done fraction of a run with docs still to start."""
+    progress = Progress()
+    progress.add_docs(4)
+    progress.start_doc(10)
+    progress.start_doc(30)
+    progress.update(pages=20)
+    # 40 pages known, 2 more docs of 20 pages expected
+    assert progress.fraction() == 0.25
+    assert progress.snapshot()["eta"] is not None
+
+
+def test_gooey_sink_matches_progress_regex():
+    """Test that GUI progress lines match the regex given to Gooey."""
+    stream = io.StringIO()
+    GooeySink(stream).write({"fraction": 0.425})
+    assert re.match(r"^progress: (\d+)%$", stream.getvalue().strip()).group(1) == "42"
+
+
+def test_auto_progress(monkeypatch):
+    """Test that auto only reports GUI progress when run from Gooey."""
+    monkeypatch.setattr(sys.stderr, "isatty", lambda: False)
+    monkeypatch.delenv("GOOEY", raising=False)
+    assert make_progress("auto").sinks == []
+    monkeypatch.setenv("GOOEY", "1")
+    assert isinstance(make_progress("auto").sinks[0], GooeySink)
+
+
+def test_json_sink(tmp_path):
+    """Test that the status file holds the latest status."""
+    path = str(tmp_path / "status.json")
+    sink = JsonSink(path)
+    sink.write({"docs_done": 1})
+    sink.write({"docs_done": 2})
+    with open(path) as status_file:
+        assert json.load(status_file) == {"docs_done": 2}
+
+
+def test_format_duration():
+    """Test ETA formatting."""
+    assert format_duration(None) == "--:--"
+    assert format_duration(75) == "01:15"
+    assert format_duration(3725) == "1:02:05"
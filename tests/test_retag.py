@@ -0,0 +1,49 @@
+# this_file: tests/test_retag.py
+"""Test rewriting the metadata of existing PDFs."""
+
+import pikepdf
+
+from pypolona.pdfmeta import META_HASH_KEY
+from pypolona.retag import retag_library
+
+from .test_verify import download
+
+
+def test_retag_only_changed_pdfs(tmp_path):
+    """Test that PDFs are retagged from sidecars and skipped when current."""
+    download(tmp_path)
+    pdf_path = str(tmp_path / "1901--test-doc--abc.pdf")
+    yaml_path = tmp_path / "1901--test-doc--abc.yaml"
+
+    assert retag_library([str(tmp_path)], processes=1)["unchanged"] == 1
+
+    yaml_path.write_text(
+        yaml_path.read_text().replace("title: Test Doc", "title: Better Title")
+    )
+    counts = retag_library([str(tmp_path)], processes=1)
+    assert counts == {"updated": 1, "unchanged": 0, "failed": 0, "no_sidecar": 0}
+    with pikepdf.open(pdf_path) as pdf:
+        assert pdf.open_metadata()["dc:title"] == "Better Title"
+        assert META_HASH_KEY in pdf.docinfo
+        assert len(pdf.pages) == 2
+
+    assert retag_library([str(tmp_path)], processes=1)["unchanged"] == 1
+
+
+def test_retag_applies_save_options(tmp_path):
+    """Test that current PDFs are still rewritten for new save options."""
+    download(tmp_path)
+    pdf_path = str(tmp_path / "1901--test-doc--abc.pdf")
+
+    counts = retag_library([str(tmp_path)], processes=1, linearize=True)
+    assert counts["updated"] == 1
+    with pikepdf.open(pdf_path) as pdf:
+        assert pdf.is_linearized
+
+
+def test_retag_counts_pdfs_without_sidecar(tmp_path):
+    """Test that PDFs without a sidecar are reported, not silently skipped."""
+    download(tmp_path)
+    (tmp_path / "1901--test-doc--abc.yaml").unlink()
+    counts = retag_library([str(tmp_path)], processes=1)
+    assert counts == {"updated": 0, "unchanged": 0, "failed": 0, "no_sidecar": 1}
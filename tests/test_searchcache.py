@@ -0,0 +1,57 @@
+# this_file: tests/test_searchcache.py
+"""Test the cache of search results."""
+
+from pypolona.client import API_URL
+from pypolona.polona import Polona
+from pypolona.searchcache import SearchCache, normalize_search_url
+
+from .test_client import FakeResponse, make_client
+
+HITS = {"hits": [{"id": "abc", "slug": "test-doc", "title": "Test Doc"}]}
+
+
+def search(tmp_path, **opts):
+    client, session = make_client()
+    polona = Polona(
+        client=client,
+        search=True,
+        advanced=False,
+        query=["test"],
+        sort="score desc",
+        search_languages=None,
+        progress="none",
+        search_cache_dir=str(tmp_path),
+        **opts,
+    )
+    session.responses[polona._search_url()] = FakeResponse(HITS)
+    polona.search()
+    return polona, session
+
+
+def test_search_results_are_cached(tmp_path):
+    """Test that a repeated search is answered from the cache."""
+    first, session = search(tmp_path)
+    assert first.ids == ["abc"]
+    assert len(session.urls) == 1
+
+    second, session = search(tmp_path)
+    assert second.ids == ["abc"]
+    assert second.hits["abc"].url == "https://polona.pl/item/test-doc,abc/"
+    assert session.urls == []
+
+    for opts in ({"refresh": True}, {"sync": True}, {"search_ttl": 0}):
+        polona, session = search(tmp_path, **opts)
+        assert polona.ids == ["abc"]
+        assert len(session.urls) == 1
+
+
+def test_cache_entries_expire(tmp_path):
+    """Test the TTL and the normalization of the cache key."""
+    url = API_URL + "?query=a&sort=score+desc&filters%5Bpublic%5D=1"
+    cache = SearchCache(str(tmp_path), ttl=60)
+    cache.put(url, [{"id": "abc"}])
+    same = API_URL + "?filters%5Bpublic%5D=1&sort=score+desc&query=a"
+    assert normalize_search_url(url) == normalize_search_url(same)
+    assert cache.get(same)[0].id == "abc"
+    assert cache.get(url + "&advanced=1") is None
+    assert SearchCache(str(tmp_path), ttl=-1).get(url) is None
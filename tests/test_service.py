@@ -0,0 +1,79 @@
+# this_file: tests/test_service.py
+"""Test the --serve job API."""
+
+import json
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from pypolona.__main__ import cli
+from pypolona.service import JobService, make_server
+
+from .test_client import make_client
+
+
+def wait_for(job):
+    for n in range(200):
+        if job.finished:
+            return job
+        time.sleep(0.02)
+    raise AssertionError("job %s did not finish" % job.id)
+
+
+def test_jobs_share_one_client(tmp_path):
+    """Test that jobs run with the CLI options and reuse the warm client."""
+    client, session = make_client()
+    service = JobService(cli().parse_args, jobs=1, client=client)
+    args = ["-I", "-D", "-T", "--progress", "bar", "-d", str(tmp_path), "abc"]
+    first = wait_for(service.submit(args))
+    second = wait_for(service.submit(args))
+    service.close()
+
+    assert first.state == "done" and second.state == "done"
+    assert first.result["done_ids"] == ["abc"]
+    assert first.opts["progress"] == "none"
+    assert (tmp_path / "1901--test-doc--abc.pdf").exists()
+    assert session.urls.count("https://polona.pl/api/entities/abc") == 1
+    metrics = service.metrics()
+    assert metrics["jobs"] == {"done": 2}
+    assert metrics["pages_done"] == 4
+    assert metrics["item_cache"]["hits"] == 1
+
+    with pytest.raises(ValueError):
+        service.submit(["--no-such-option"])
+    for args in (["-I", "-D", "-d", "-", "abc"], ["--profile", "cpu", "-S", "x"]):
+        with pytest.raises(ValueError):
+            service.submit(args)
+    # Runs copy the shared item before recording their page selection
+    assert "selected_pages" not in client.get_item("abc")
+
+
+def test_http_api(tmp_path):
+    """Test submitting a job and reading its status over HTTP."""
+    client, session = make_client()
+    service = JobService(cli().parse_args, jobs=1, client=client)
+    server = make_server("127.0.0.1:0", service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+    try:
+        request = urllib.request.Request(
+            url + "/jobs",
+            data=json.dumps({"args": ["-I", "-D", "-d", str(tmp_path), "abc"]}).encode(),
+            method="POST",
+        )
+        with urllib.request.urlopen(request) as response:
+            assert response.status == 202
+            job_id = json.load(response)["id"]
+        wait_for(service.job(job_id))
+        with urllib.request.urlopen(url + "/jobs/" + job_id) as response:
+            status = json.load(response)
+        assert status["state"] == "done"
+        assert status["progress"]["docs_done"] == 1
+        with urllib.request.urlopen(url + "/metrics") as response:
+            assert json.load(response)["jobs"] == {"done": 1}
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
@@ -0,0 +1,59 @@
+# this_file: tests/test_storage.py
+"""Test disk space checks and file writing."""
+
+from unittest.mock import patch
+
+import pytest
+from orderedattrdict import AttrDict
+
+from pypolona.polona import Polona
+from pypolona.storage import NotEnoughSpace, format_size, write_file
+
+
+def make_polona(tmp_path, **opts):
+    polona = Polona(download_dir=str(tmp_path), images=False, textpdf_skip=True, **opts)
+    polona._make_dldir()
+    return polona
+
+
+def test_write_file_preallocated(tmp_path):
+    """Test that preallocated files end up with exactly the written data."""
+    path = tmp_path / "page.jpg"
+    write_file(str(path), b"\xff\xd8data\xff\xd9", prealloc=True)
+    assert path.read_bytes() == b"\xff\xd8data\xff\xd9"
+
+
+def test_format_size():
+    """Test human-readable sizes."""
+    assert format_size(512) == "512.0 B"
+    assert format_size(3 * 1024 * 1024) == "3.0 MB"
+
+
+def test_check_space_raises_when_doc_does_not_fit(tmp_path):
+    """Test that a doc larger than the free space is refused up front."""
+    polona = make_polona(tmp_path, min_free=0)
+    scans = [{"resources": [{"mime": "image/jpeg", "url": "u%d" % i}]} for i in range(10)]
+    with patch("pypolona.polona.free_space", return_value=5 * 1024 * 1024), patch.object(
+        Polona, "_content_length", return_value=1024 * 1024
+    ):
+        with pytest.raises(NotEnoughSpace) as e:
+            polona.check_space(AttrDict(id="x"), scans)
+    assert e.value.needed == 10 * 1024 * 1024
+
+
+def test_download_ids_postpones_docs_that_do_not_fit(tmp_path):
+    """Test that docs without enough space are retried after the others."""
+    polona = make_polona(tmp_path, space_wait=0)
+    polona.ids = ["big", "small"]
+    attempts = []
+
+    def download_id(id, progress):
+        attempts.append(id)
+        if id == "big" and attempts.count("big") == 1:
+            raise NotEnoughSpace(str(tmp_path), 100, 10)
+        return True
+
+    with patch.object(Polona, "download_id", side_effect=download_id):
+        polona.download_ids()
+    assert attempts == ["big", "small", "big"]
+    assert polona.done_ids == ["small", "big"]
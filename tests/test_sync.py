@@ -0,0 +1,40 @@
+# this_file: tests/test_sync.py
+"""Test the incremental sync state of saved searches."""
+
+from pypolona.sync import SyncState, search_key
+
+
+def test_search_key_is_stable():
+    """Test that the same search URL always maps to the same key."""
+    url = "https://polona.pl/api/entities/?query=test"
+    assert search_key(url) == search_key(url)
+    assert search_key(url) != search_key(url + "&advanced=1")
+
+
+def test_sync_state_reports_only_new_ids(tmp_path):
+    """Test that marked IDs are not reported again in later runs."""
+    path = str(tmp_path / "sync.json")
+    url = "https://polona.pl/api/entities/?query=test"
+
+    state = SyncState(path, url)
+    assert state.update(["1", "2"]) == ["1", "2"]
+    state.mark(["1"])
+    state.save()
+
+    state = SyncState(path, url)
+    assert state.previous_run is None
+    assert state.update(["1", "2", "3"]) == ["2", "3"]
+    assert state.previous_run is not None
+    assert state.results == ["1", "2", "3"]
+
+
+def test_sync_state_ignores_other_search(tmp_path):
+    """Test that a state file saved for another search is not reused."""
+    path = str(tmp_path / "sync.json")
+    state = SyncState(path, "https://polona.pl/api/entities/?query=a")
+    state.update(["1"])
+    state.mark(["1"])
+    state.save()
+
+    state = SyncState(path, "https://polona.pl/api/entities/?query=b")
+    assert state.update(["1"]) == ["1"]
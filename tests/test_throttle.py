@@ -0,0 +1,154 @@
+# this_file: tests/test_throttle.py
+"""Test the --limit-rate bandwidth limit and concurrent downloads."""
+
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from pypolona.client import API_URL, CHUNK_SIZE, PolonaClient
+from pypolona.polona import Polona
+from pypolona.throttle import RateLimiter
+
+from .test_client import ITEM, FakeResponse, FakeSession, make_client
+
+
+def test_rate_is_enforced():
+    """Test that bytes beyond the burst are paid for with waiting."""
+    limiter = RateLimiter(10000)
+    start = time.monotonic()
+    for n in range(3):
+        limiter.consume(10000)
+    # The first 10000 bytes are the burst, the other 20000 the debt
+    assert time.monotonic() - start >= 0.15
+
+
+def test_least_served_doc_goes_first():
+    """Test that waiting docs get the bandwidth in order of bytes served."""
+    limiter = RateLimiter(100000)
+    order = []
+
+    def doc(name, served):
+        limiter.start_doc()
+        limiter.served[threading.get_ident()] = served
+        limiter.consume(1)
+        order.append(name)
+
+    # Put the bucket into debt so that both docs have to wait
+    limiter.consume(limiter.burst + 10000)
+    big = threading.Thread(target=doc, args=("big", 10 ** 9))
+    small = threading.Thread(target=doc, args=("small", 0))
+    big.start()
+    time.sleep(0.02)
+    small.start()
+    big.join()
+    small.join()
+    assert order == ["small", "big"]
+
+
+def test_concurrent_jobs_shortest_first(tmp_path):
+    """Test that --jobs downloads all docs and --sjf orders them by pages."""
+    client, session = make_client()
+    short = dict(ITEM, id="def", slug="short-doc", scans=ITEM["scans"][:1])
+    session.responses[API_URL + "def"] = FakeResponse(short)
+    polona = Polona(
+        client=client,
+        download=True,
+        download_dir=str(tmp_path),
+        max_pages=0,
+        images=False,
+        textpdf_skip=True,
+        skip=False,
+        progress="none",
+        jobs=2,
+        sjf=True,
+        limit_rate=100,
+    )
+    polona.ids = ["abc", "def"]
+    assert polona.shortest_first(list(enumerate(polona.ids))) == [
+        (1, "def"),
+        (0, "abc"),
+    ]
+    polona.download()
+    assert sorted(polona.done_ids) == ["abc", "def"]
+    assert polona.limiter is not None
+    assert (tmp_path / "1901--short-doc--def.pdf").exists()
+
+
+def test_parallel_jobs_refused_on_stdout():
+    """Test that one tar stream on stdout is not written by several jobs."""
+    client, session = make_client()
+    polona = Polona(
+        client=client, download=True, download_dir="-", format_out="tar", jobs=2
+    )
+    polona.ids = ["abc"]
+    polona.download()
+    assert polona.archive is None
+    assert session.urls == []
+
+
+def test_limit_is_charged_per_chunk():
+    """Test that responses are read in chunks that each wait for bandwidth."""
+
+    class Recorder:
+        def __init__(self):
+            self.sizes = []
+
+        def consume(self, nbytes):
+            self.sizes.append(nbytes)
+
+    body = b"x" * (CHUNK_SIZE * 2 + 10)
+    client = PolonaClient(session=FakeSession({"big": FakeResponse(content=body)}))
+    recorder = Recorder()
+    assert client.get("big", limiter=recorder).content == body
+    assert recorder.sizes == [CHUNK_SIZE, CHUNK_SIZE, 10]
+    assert not hasattr(client, "limiter")
+
+
+def test_limit_is_shared_by_workers(tmp_path):
+    """Test that --workers processes split the --limit-rate between them."""
+    polona = Polona(
+        download=True,
+        download_dir=str(tmp_path),
+        queue=str(tmp_path / "queue.sqlite"),
+        workers=4,
+        limit_rate=2,
+        progress="none",
+    )
+    rates = []
+
+    class FakeProcess:
+        def __init__(self, target, args):
+            rates.append(args[0]["limit_rate"])
+
+        def start(self):
+            pass
+
+        def is_alive(self):
+            return False
+
+        def join(self, timeout=None):
+            pass
+
+    context = SimpleNamespace(Process=FakeProcess)
+    with patch("multiprocessing.get_context", return_value=context):
+        polona.download()
+    assert rates == [0.5] * 4
+
+
+def test_sjf_fetches_each_item_once(tmp_path):
+    """Test that --sjf keeps the items it fetched for the downloads."""
+    ids = ["doc%02d" % n for n in range(10)]
+    session = FakeSession(
+        {API_URL + id: FakeResponse(dict(ITEM, id=id, scans=[])) for id in ids}
+    )
+    polona = Polona(
+        client=PolonaClient(session=session, cache_size=2),
+        download=True,
+        download_dir=str(tmp_path),
+        sjf=True,
+        progress="none",
+    )
+    polona.ids = ids
+    polona.download()
+    assert sorted(session.urls) == [API_URL + id for id in ids]
@@ -0,0 +1,62 @@
+# this_file: tests/test_transcode.py
+"""Test the optional transcoding of scans."""
+
+import io
+
+import img2pdf
+import pikepdf
+from PIL import Image
+
+from pypolona.transcode import Transcoder, transcode_image
+
+
+def make_jpeg(color=(250, 250, 250), size=(400, 600), dpi=600):
+    out = io.BytesIO()
+    Image.new("RGB", size, color).save(out, "JPEG", quality=95, dpi=(dpi, dpi))
+    return out.getvalue()
+
+
+def test_downscale_to_dpi():
+    """Test that scans are downscaled, keeping their physical size."""
+    im = Image.open(io.BytesIO(transcode_image(make_jpeg(), dpi=150)))
+    assert im.size == (100, 150)
+    assert im.info["dpi"] == (150, 150)
+
+
+def test_no_upscale():
+    """Test that a target DPI above the scan's resolution changes nothing."""
+    im = Image.open(io.BytesIO(transcode_image(make_jpeg(dpi=100), dpi=300)))
+    assert im.size == (400, 600)
+
+
+def test_color_modes():
+    """Test grayscale, bitonal and automatic color conversion."""
+    gray = Image.open(io.BytesIO(transcode_image(make_jpeg(), color="auto")))
+    assert gray.mode == "L"
+    red = make_jpeg(color=(200, 20, 20))
+    assert Image.open(io.BytesIO(transcode_image(red, color="auto"))).mode == "RGB"
+    bitonal = transcode_image(make_jpeg(), color="bitonal")
+    assert Image.open(io.BytesIO(bitonal)).mode == "1"
+    # img2pdf must accept every output format
+    assert img2pdf.convert([bitonal, transcode_image(red, quality=50)])
+
+
+def test_transcoder_pool_reports_sizes():
+    """Test transcoding in the process pool."""
+    transcoder = Transcoder(processes=1, dpi=150)
+    try:
+        images, size_in, size_out = transcoder.transcode([make_jpeg(), make_jpeg()])
+    finally:
+        transcoder.close()
+    assert len(images) == 2
+    assert size_out < size_in
+    assert transcoder.bytes_in == size_in
+
+
+def test_page_size_kept():
+    """Test that the PDF page keeps the scan's physical size in every format."""
+    scan = make_jpeg(size=(600, 900), dpi=300)
+    for settings in ({}, {"jp2": True}, {"dpi": 150, "jp2": True}, {"dpi": 150}):
+        data = transcode_image(scan, **settings) if settings else scan
+        pdf = pikepdf.open(io.BytesIO(img2pdf.convert(data)))
+        assert [float(v) for v in pdf.pages[0].MediaBox] == [0, 0, 144, 216], settings
@@ -0,0 +1,74 @@
+# this_file: tests/test_verify.py
+"""Test the verification of existing downloads."""
+
+from pypolona.polona import Polona
+from pypolona.verify import jpeg_complete, verify_library
+
+from .test_client import make_client
+
+
+def download(tmp_path, **opts):
+    client, session = make_client()
+    polona = Polona(
+        client=client,
+        **{
+            "download": True,
+            "download_dir": str(tmp_path),
+            "max_pages": 0,
+            "images": False,
+            "textpdf_skip": True,
+            "skip": False,
+            "progress": "none",
+            **opts,
+        }
+    )
+    polona.ids = ["abc"]
+    polona.download()
+
+
+def test_jpeg_complete(tmp_path):
+    """Test the JPEG start and end marker check."""
+    path = tmp_path / "page.jpg"
+    path.write_bytes(b"\xff\xd8data\xff\xd9\0\0")
+    assert jpeg_complete(str(path))
+    path.write_bytes(b"\xff\xd8data")
+    assert not jpeg_complete(str(path))
+    assert not jpeg_complete(str(tmp_path / "missing.jpg"))
+
+
+def test_verify_complete_downloads(tmp_path):
+    """Test that complete PDFs and folders pass."""
+    download(tmp_path / "pdf")
+    download(tmp_path / "images", images=True, pages="2")
+    count, broken = verify_library([str(tmp_path)], processes=2)
+    assert count == 2
+    assert broken == {}
+
+
+def test_skipped_doc_keeps_sidecar(tmp_path):
+    """Test that -O with other --pages leaves the sidecar of the saved PDF."""
+    download(tmp_path)
+    download(tmp_path, skip=True, pages="1")
+    count, broken = verify_library([str(tmp_path)], processes=1)
+    assert broken == {}
+
+
+def test_verify_finds_broken_downloads(tmp_path):
+    """Test that truncated JPEGs and PDFs with missing pages are reported."""
+    download(tmp_path, images=True)
+    jpeg = tmp_path / "1901--test-doc--abc" / "abc-0002.jpg"
+    jpeg.write_bytes(jpeg.read_bytes()[:100])
+    count, broken = verify_library([str(tmp_path)], processes=1)
+    assert list(broken) == ["abc"]
+    assert broken["abc"][0] == "test-doc"
+    assert "abc-0002.jpg" in broken["abc"][1][0]
+
+    download(tmp_path, pages="1")
+    (tmp_path / "1901--test-doc--abc.yaml").write_text(
+        (tmp_path / "1901--test-doc--abc.yaml")
+        .read_text()
+        .replace("selected_pages:\n- 1\n", "selected_pages:\n- 1\n- 2\n")
+    )
+    count, broken = verify_library([str(tmp_path)], processes=1)
+    assert count == 2
+    assert any("has 1 of 2 pages" in problem for problem in broken["abc"][1])
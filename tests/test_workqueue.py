@@ -0,0 +1,85 @@
+# this_file: tests/test_workqueue.py
+"""Test the shared work queue used by --queue and --workers."""
+
+import time
+
+import pytest
+
+from pypolona.workqueue import (
+    SQLiteQueue,
+    WorkQueue,
+    open_queue,
+    register_queue_backend,
+)
+
+
+def test_queue_leases_each_id_once(tmp_path):
+    """Test that queued IDs are deduplicated and leased to one worker only."""
+    queue = open_queue(str(tmp_path / "queue.sqlite"))
+    queue.put(["a", "b"])
+    queue.put(["b", "c"])
+
+    leased = [queue.lease("w1"), queue.lease("w2"), queue.lease("w1")]
+    assert sorted(leased) == ["a", "b", "c"]
+    assert queue.lease("w2") is None
+
+    for id in leased:
+        queue.complete(id, "w1")
+    assert queue.done(["a", "c", "x"]) == ["a", "c"]
+    assert queue.counts() == {"done": 3}
+
+
+def test_expired_lease_is_retried(tmp_path):
+    """Test that the ID of a dead worker is handed out again."""
+    queue = SQLiteQueue(str(tmp_path / "queue.sqlite"), lease_time=0.01)
+    queue.put(["a"])
+    assert queue.lease("dead") == "a"
+    time.sleep(0.05)
+    assert queue.lease("alive") == "a"
+
+
+def test_failed_id_gives_up_after_max_attempts(tmp_path):
+    """Test that an ID is retried until max_attempts, then marked failed."""
+    queue = SQLiteQueue(str(tmp_path / "queue.sqlite"), max_attempts=2)
+    queue.put(["a"])
+    for _ in range(2):
+        assert queue.lease("w1") == "a"
+        queue.fail("a", "w1", "download failed")
+    assert queue.lease("w1") is None
+    assert queue.counts() == {"failed": 1}
+
+
+def test_released_id_keeps_its_attempts(tmp_path):
+    """Test that a cancelled lease does not count as an attempt."""
+    queue = SQLiteQueue(str(tmp_path / "queue.sqlite"), max_attempts=1)
+    queue.put(["a"])
+    for _ in range(3):
+        assert queue.lease("w1") == "a"
+        queue.release("a", "w1")
+    assert queue.counts() == {"pending": 1}
+    assert queue.lease("w1") == "a"
+    queue.fail("a", "w1", "download failed")
+    assert queue.counts() == {"failed": 1}
+
+def test_queue_backends():
+    """Test that queue locations dispatch on their scheme."""
+
+    class DummyQueue:
+        def __init__(self, location, **kwargs):
+            self.location = location
+
+    register_queue_backend("dummy", DummyQueue)
+    assert open_queue("dummy://host/q").location == "dummy://host/q"
+    with pytest.raises(ValueError):
+        open_queue("nosuch://host/q")
+
+
+def test_queue_backend_interface():
+    """Test that a backend must implement every WorkQueue method."""
+
+    class PartialQueue(WorkQueue):
+        def put(self, ids):
+            pass
+
+    with pytest.raises(TypeError):
+        PartialQueue()